@@ -5,135 +5,436 @@ import sys
 import os
 import getopt
 import vcf
+import pysam
+import numpy as np
+from fastaio import read_fasta, stream_fasta, open_input, header_name
+
+#Depths above this are stored as this value
+DEPTH_CAP = np.iinfo(np.uint16).max
+#Output is written in chunks of about this many bytes
+WRITE_CHUNK = 1 << 20
+#Bases per block in streaming mode
+STREAM_BLOCK = 1 << 20
 
 def main():
 	params = parseArgs()
 
+	#with --per-sample, -o is the output directory: create it before any
+	#input is parsed
+	if params.per_sample and params.out:
+		try:
+			os.makedirs(params.out, exist_ok=True)
+		except OSError as e:
+			print("Could not create output directory %s: %s"%(params.out,e))
+			sys.exit(1)
+
+	if params.stream:
+		stream_consensus(params)
+		return
+
 	#Grab reference sequence first
 	reference = dict()
-	for contig in read_fasta(params.ref):
+	for contig in read_fasta(params.ref, mode="bytes", threads=params.threads):
 		name = contig[0].split()[0]
 		reference[name] = contig[1] #don't forget: 0-based index here, 1-based in VCF
 
-	vfh = vcf.Reader(open(params.vcf, 'r'))
+	vfh = vcf.Reader(open_input(params.vcf, params.threads, text=True), compressed=False)
 
 	#grab contig sizes
 	contigs = dict()
 	for c,s in vfh.contigs.items():
 		contigs[s.id] = s.length
 
-	#Data structure with:
-	#For each chromosome:
-	#	for each position:
-	#		mpileup depth
-	#		VCF ALT allele
-	#Dict of lists [N] of lists [2]
+	if len(params.pileup) > 1:
+		multi_sample(params, reference, vfh)
+		return
+
+	#Data structures, for each chromosome:
+	#	depth: uint16 array of mpileup depth per position (saturating at DEPTH_CAP)
+	#	alts: sparse index of VCF ALT alleles, as (sorted positions, alleles)
+	depth = read_depth(params.pileup[0], reference, params.threads)
+
+	#Parse VCF to grab genotypes
+	#Note this doesn't pay attention to samples. just keeps all ALT alleles
+	found = dict()
+	for rec in vfh:
+		chrom = rec.CHROM
+		pos = int(rec.POS)-1
+		chosen = shortest_alt(rec)
+
+		if chrom not in reference or chosen is None:
+			pass
+		else:
+			if pos < len(reference[chrom]):
+				found.setdefault(chrom, dict())[pos] = chosen
+	alts = sparse_index(found, reference)
+	del found
+
+	#Build each chromosome's consensus for sample and write it
+	fh = open_output(params.out, params.bgzip)
+	try:
+		for chrom, seq in reference.items():
+			positions, alleles = alts[chrom]
+			cons = build_consensus(seq, depth[chrom] >= params.cov, positions, alleles)
+			write_record(fh, "%s_%s"%(chrom, params.sample), cons, params.width)
+	finally:
+		close_output(fh, params.out, params.bgzip)
+
+#Multi-sample mode: one mpileup per sample, and each sample's own genotype
+#alleles, with all samples built from a single pass over the VCF
+def multi_sample(params, reference, vfh):
+	#sample names are taken before the first "." of the mpileup file name
+	#(and of the VCF column), as in vcf2msa.py
+	covered = dict()
+	for pileup in params.pileup:
+		samp = os.path.basename(pileup).split(".")[0]
+		if samp in covered:
+			print("Sample %s given more than one mpileup file"%samp)
+			sys.exit(1)
+		#keep only depth >= cov, packed to one bit per base
+		covered[samp] = dict()
+		for chrom, d in read_depth(pileup, reference, params.threads).items():
+			covered[samp][chrom] = np.packbits(d >= params.cov)
+
+	missing = [s for s in covered if s not in [v.split(".")[0] for v in vfh.samples]]
+	if missing:
+		print("Warning: No VCF genotypes for samples:", missing)
+
+	#Parse VCF once, choosing each sample's own ALT allele per record
+	found = dict()
+	for samp in covered:
+		found[samp] = dict()
+	for rec in vfh:
+		chrom = rec.CHROM
+		pos = int(rec.POS)-1
+		if chrom not in reference or pos >= len(reference[chrom]):
+			continue
+		for call in rec.samples:
+			samp = call.sample.split(".")[0]
+			if samp not in found or not call.called:
+				continue
+			chosen = sample_allele(rec, call, found[samp].get(chrom, dict()).get(pos))
+			if chosen is not None:
+				found[samp].setdefault(chrom, dict())[pos] = chosen
+
+	#Write all samples, to one multi-FASTA or one file per sample
+	fh = None
+	if not params.per_sample:
+		fh = open_output(params.out, params.bgzip)
+	try:
+		for samp in covered:
+			alts = sparse_index(found[samp], reference)
+			del found[samp]
+			if params.per_sample:
+				out = os.path.join(params.out or ".", samp + (".fasta.gz" if params.bgzip else ".fasta"))
+				fh = open_output(out, params.bgzip)
+			for chrom, seq in reference.items():
+				mask = np.unpackbits(covered[samp][chrom], count=len(seq)).astype(bool)
+				positions, alleles = alts[chrom]
+				cons = build_consensus(seq, mask, positions, alleles)
+				write_record(fh, "%s_%s"%(chrom, samp), cons, params.width)
+			if params.per_sample:
+				close_output(fh, out, params.bgzip)
+				fh = None
+	finally:
+		if fh is not None:
+			close_output(fh, params.out, params.bgzip)
+
+#Streaming mode: merge-join the reference, mpileup(s) and VCF, which must all
+#be sorted in reference contig order. Consensus is built and written block by
+#block, so memory does not depend on genome size
+def stream_consensus(params):
+	order = contig_order(params.ref, params.threads)
+	multi = len(params.pileup) > 1
+	if multi:
+		samples = [os.path.basename(p).split(".")[0] for p in params.pileup]
+	else:
+		samples = [params.sample]
+	depths = [SortedStream(p, read_pileup(p, params.threads), order) for p in params.pileup]
+	vfh = vcf.Reader(open_input(params.vcf, params.threads, text=True), compressed=False)
+	records = SortedStream(params.vcf, ((rec.CHROM, int(rec.POS)-1, rec) for rec in vfh), order)
+
+	#one output per sample (multi-sample mode requires --per-sample)
+	outs = list()
+	if multi:
+		for samp in samples:
+			outs.append(os.path.join(params.out or ".", samp + (".fasta.gz" if params.bgzip else ".fasta")))
+	else:
+		outs.append(params.out)
+	handles = [open_output(o, params.bgzip) for o in outs]
+	writers = [FastaWriter(fh, params.width) for fh in handles]
+
+	try:
+		ci = None
+		for name, start, chunk in stream_fasta(params.ref, STREAM_BLOCK, threads=params.threads):
+			if ci is None or name != contig:
+				if ci is not None:
+					finish_contig(ci, depths, records, writers)
+				contig = name
+				ci = order[name]
+				for samp, w in zip(samples, writers):
+					w.start("%s_%s"%(contig, samp))
+			end = start + len(chunk)
 
-	data = dict()
+			#coverage of each sample within this block
+			covered = list()
+			for stream in depths:
+				c = np.full(len(chunk), 0 >= params.cov, dtype=bool)
+				for pos, d in stream.take(ci, end):
+					c[pos - start] = d >= params.cov
+				covered.append(c)
+
+			#ALT alleles within this block, for each sample
+			found = [dict() for samp in samples]
+			for pos, rec in records.take(ci, end):
+				if not multi:
+					chosen = shortest_alt(rec)
+					if chosen is not None:
+						found[0][pos - start] = chosen
+					continue
+				for call in rec.samples:
+					samp = call.sample.split(".")[0]
+					if samp not in samples or not call.called:
+						continue
+					k = samples.index(samp)
+					chosen = sample_allele(rec, call, found[k].get(pos - start))
+					if chosen is not None:
+						found[k][pos - start] = chosen
+
+			for k, w in enumerate(writers):
+				positions = sorted(found[k])
+				alleles = [found[k][p] for p in positions]
+				w.write(build_consensus(chunk, covered[k], np.array(positions, dtype=np.int64), alleles))
+		if ci is not None:
+			finish_contig(ci, depths, records, writers)
+	finally:
+		for fh, out in zip(handles, outs):
+			close_output(fh, out, params.bgzip)
+
+#End the current contig: skip any records past its end, and end its records
+def finish_contig(ci, depths, records, writers):
+	for stream in depths + [records]:
+		for item in stream.take(ci, float("inf")):
+			pass
+	for w in writers:
+		w.end()
+
+#Sorted input stream of (chrom, pos, item), with chromosomes ordered as in
+#the reference. Records on contigs not in the reference are skipped, and
+#anything out of order is reported as an error
+class SortedStream():
+	def __init__(self, name, records, order):
+		self.name = name
+		self.records = iter(records)
+		self.order = order
+		self.last = None
+		self.head = None
+		self.advance()
+
+	def advance(self):
+		self.head = None
+		for chrom, pos, item in self.records:
+			if chrom not in self.order:
+				continue
+			key = (self.order[chrom], pos)
+			if self.last is not None and key < self.last:
+				#stdout may be the consensus output, so report on stderr
+				print("Input out of order in %s: %s:%d found after %s:%d"%(
+					self.name, chrom, pos+1, self.chrom, self.last[1]+1), file=sys.stderr)
+				print("All inputs must be sorted in the same contig order as the reference", file=sys.stderr)
+				sys.exit(1)
+			self.last = key
+			self.chrom = chrom
+			self.head = (key, item)
+			return
+
+	#Generator yielding (pos, item) for records on contig ci before end
+	def take(self, ci, end):
+		while self.head is not None and self.head[0][0] == ci and self.head[0][1] < end:
+			pos, item = self.head[0][1], self.head[1]
+			self.advance()
+			yield(pos, item)
+
+#Get reference contig names in file order, from the .fai index if present
+def contig_order(fas, threads=1):
+	order = dict()
+	if os.path.exists(fas + ".fai"):
+		with open(fas + ".fai") as fh:
+			for line in fh:
+				order.setdefault(line.split("\t")[0], len(order))
+		return(order)
+	with open_input(fas, threads) as fh:
+		for line in fh:
+			if line.startswith(b">"):
+				order.setdefault(header_name(line.strip(), True), len(order))
+	return(order)
+
+#Parse an mpileup file, yielding (chrom, 0-based pos, depth) for each line
+def read_pileup(pileup, threads=1):
+	with open_input(pileup, threads, text=True) as PILEUP:
+		try:
+			for l in PILEUP:
+				line = l.split()
+				yield(line[0], int(line[1])-1, min(int(line[3]), DEPTH_CAP))
+		except IOError as e:
+			print("Could not read file %s: %s"%(pileup,e))
+			sys.exit(1)
+
+#Choose the ALT allele for a record, ignoring samples: if more than one ALT
+#allele, choose shortest (i.e. SNP over indel, or shortest indel), or keep
+#first if equal
+def shortest_alt(rec):
+	chosen = rec.ALT[0]
+	if len(rec.ALT) > 1:
+		for a in rec.ALT:
+			if len(a) < len(chosen):
+				chosen = a
+	if chosen is None:
+		return(None)
+	return(str(chosen))
+
+#Choose a sample's allele at a record: its shortest non-REF called allele
+#(as for ALT alleles in single-sample mode), or None if it carries only REF
+#prev is an allele already chosen at this position (e.g. another VCF column)
+def sample_allele(rec, call, prev=None):
+	chosen = prev
+	for a in call.gt_alleles:
+		if a is None or a == "0":
+			continue
+		allele = rec.alleles[int(a)]
+		if allele is None:
+			continue
+		allele = str(allele)
+		if chosen is None or len(allele) < len(chosen):
+			chosen = allele
+	return(chosen)
+
+#Parse an mpileup file into a uint16 depth array per reference chromosome
+def read_depth(pileup, reference, threads=1):
+	depth = dict()
 	for chrom, seq in reference.items():
-		l1 = [None] * len(seq)
-		l2 = [None] * len(seq)
-		data[chrom] = [l1, l2]
+		depth[chrom] = np.zeros(len(seq), dtype=np.uint16)
 
-	#First parse the mpileup file
-	with open(params.pileup, 'r') as PILEUP:
+	with open_input(pileup, threads, text=True) as PILEUP:
 		try:
 			for l in PILEUP:
 				line = l.split()
 				chrom = line[0]
 				pos = int(line[1])-1
-				depth = line[3]
-				if chrom not in data:
+				if chrom not in depth:
 					pass
 				else:
-					if pos < len(data[chrom][0]):
-						data[chrom][0][pos] = depth
+					if pos < len(depth[chrom]):
+						depth[chrom][pos] = min(int(line[3]), DEPTH_CAP)
 		except IOError as e:
-			print("Could not read file %s: %s"%(params.pileup,e))
+			print("Could not read file %s: %s"%(pileup,e))
 			sys.exit(1)
 		except Exception as e:
-			print("Unexpected error reading file %s: %s"%(params.pileup,e))
+			print("Unexpected error reading file %s: %s"%(pileup,e))
 			sys.exit(1)
 		finally:
 			PILEUP.close()
+	return(depth)
 
-	#Parse VCF to grab genotypes
-	#Note this doesn't pay attention to samples. just keeps all ALT alleles
-	for rec in vfh:
-		chrom = rec.CHROM
-		pos = int(rec.POS)-1
-		allele = rec.ALT
-		chosen = rec.ALT[0]
-
-		#if more than one ALT allele, choose shortest
-		#(i.e. SNP over indel, or shortest indel)
-		#or keep first if equal
-		if len(allele) > 1:
-			for a in allele:
-				if len(a) < len(chosen):
-					chosen = a
-
-		if chrom not in data:
-			pass
-		else:
-			if pos < len(data[chrom][1]):
-				data[chrom][1][pos] = chosen
+#Convert {chrom: {pos: allele}} to {chrom: (sorted positions, alleles)}
+def sparse_index(found, reference):
+	alts = dict()
+	for chrom in reference:
+		positions = sorted(found.get(chrom, dict()))
+		alts[chrom] = (np.array(positions, dtype=np.int64), [found[chrom][p] for p in positions])
+	return(alts)
 
-	#For each position in chromosome, write new one for sample
-	for chrom, seq in reference.items():
-		print(">%s_%s"%(chrom, params.sample))
-		for position, nuc in enumerate(seq):
-			if int(data[chrom][0][position]) >= params.cov:
-				if data[chrom][1][position] != None:
-					if data[chrom][1][position] == "*":
-						pass
-					else:
-						print(str(data[chrom][1][position]), end="")
-				else:
-					print(nuc, end="")
-			else:
-				print("N",end="")
-		print()
+#Build consensus bytes for one chromosome:
+#start from the reference, write N where not covered (depth < cov), then
+#splice in ALT alleles at covered positions ("*" deletes the base)
+def build_consensus(seq, covered, positions, alleles):
+	if isinstance(seq, str):
+		seq = seq.encode()
+	cons = np.frombuffer(seq, dtype=np.uint8).copy()
+	cons[~covered] = ord("N")
+	keep = np.flatnonzero(covered[positions])
+	#single-base substitutions are applied in place
+	snp = [k for k in keep if len(alleles[k]) == 1 and alleles[k] != "*"]
+	if snp:
+		cons[positions[snp]] = np.frombuffer("".join(alleles[k] for k in snp).encode(), dtype=np.uint8)
+	#anything that changes the length is spliced in
+	splice = [k for k in keep if len(alleles[k]) != 1 or alleles[k] == "*"]
+	if not splice:
+		return(cons.tobytes())
+	pieces = list()
+	prev = 0
+	for k in splice:
+		p = positions[k]
+		pieces.append(cons[prev:p].tobytes())
+		if alleles[k] != "*":
+			pieces.append(alleles[k].encode())
+		prev = p + 1
+	pieces.append(cons[prev:].tobytes())
+	return(b"".join(pieces))
 
+#Open output for binary writing: stdout, a plain file, or a BGZF file
+def open_output(out, bgzip=False):
+	if not out:
+		return(sys.stdout.buffer)
+	if bgzip:
+		return(pysam.BGZFile(out, "wb"))
+	return(open(out, "wb", buffering=WRITE_CHUNK))
 
-#Read genome as FASTA. FASTA header will be used
-#This is a generator function
-#Doesn't matter if sequences are interleaved or not.
-def read_fasta(fas):
+#Close output opened by open_output(), indexing it if bgzipped
+def close_output(fh, out, bgzip=False):
+	if fh is sys.stdout.buffer:
+		fh.flush()
+		return
+	fh.close()
+	if bgzip:
+		pysam.faidx(out)
+
+#Function to write a FASTA record wrapped to <width> columns (0 = no wrapping)
+def write_record(fh, name, seq, width):
+	w = FastaWriter(fh, width)
+	w.start(name)
+	w.write(seq)
+	w.end()
+
+#FASTA writer for sequences given in pieces, wrapped to <width> columns
+#(0 = no wrapping). Lines are joined into large chunks before writing
+class FastaWriter():
+	def __init__(self, fh, width):
+		self.fh = fh
+		self.width = width
+		self.pending = b""
+
+	def start(self, name):
+		self.fh.write((">" + name + "\n").encode())
+		self.pending = b""
+
+	def write(self, seq):
+		if not self.width:
+			self.fh.write(seq)
+			return
+		data = self.pending + seq
+		full = len(data) - len(data) % self.width
+		step = self.width * max(1, WRITE_CHUNK // self.width)
+		for i in range(0, full, step):
+			block = data[i:min(i+step, full)]
+			self.fh.write(b"\n".join([block[j:j+self.width] for j in range(0, len(block), self.width)]) + b"\n")
+		self.pending = data[full:]
+
+	def end(self):
+		if not self.width:
+			self.fh.write(b"\n")
+		elif self.pending:
+			self.fh.write(self.pending + b"\n")
+		self.pending = b""
 
-	fh = open(fas)
-	try:
-		with fh as file_object:
-			contig = ""
-			seq = ""
-			for line in file_object:
-				line = line.strip()
-				if not line:
-					continue
-				#print(line)
-				if line[0] == ">": #Found a header line
-					#If we already loaded a contig, yield that contig and
-					#start loading a new one
-					if contig:
-						yield([contig,seq]) #yield
-						contig = "" #reset contig and seq
-						seq = ""
-					contig = (line.replace(">",""))
-				else:
-					seq += line
-		#Iyield last sequence, if it has both a header and sequence
-		if contig and seq:
-			yield([contig,seq])
-	finally:
-		fh.close()
 
 #Object to parse command-line arguments
 class parseArgs():
 	def __init__(self):
 		#Define options
 		try:
-			options, remainder = getopt.getopt(sys.argv[1:], 'r:v:m:c:R:hs:', \
-			["vcf=", "help", "ref=", "mpileup=","cov=","region=","sample="])
+			options, remainder = getopt.getopt(sys.argv[1:], 'r:v:m:c:R:hs:o:w:zt:', \
+			["vcf=", "help", "ref=", "mpileup=","cov=","region=","sample=","out=","width=","bgzip","per-sample","stream","threads="])
 		except getopt.GetoptError as err:
 			print(err)
 			self.display_help("\nExiting because getopt returned non-zero exit status.")
@@ -141,9 +442,15 @@ class parseArgs():
 		#Input params
 		self.vcf=None
 		self.ref=None
-		self.pileup=None
+		self.pileup=list()
 		self.cov=0
 		self.sample="sample"
+		self.out=None
+		self.width=60
+		self.bgzip=False
+		self.per_sample=False
+		self.stream=False
+		self.threads=1
 
 		#First pass to see if help menu was called
 		for o, a in options:
@@ -161,13 +468,25 @@ class parseArgs():
 			elif opt in ('c','cov'):
 				self.cov=int(arg)
 			elif opt in ('m','mpileup'):
-				self.pileup=arg
+				self.pileup.append(arg)
 			elif opt in ('r','ref'):
 				self.ref=arg
 			elif opt in ('h', 'help'):
 				pass
 			elif opt in ('s','sample'):
 				self.sample=arg
+			elif opt in ('o','out'):
+				self.out=arg
+			elif opt in ('w','width'):
+				self.width=int(arg)
+			elif opt in ('z','bgzip'):
+				self.bgzip=True
+			elif opt == 'persample':
+				self.per_sample=True
+			elif opt == 'stream':
+				self.stream=True
+			elif opt in ('t','threads'):
+				self.threads=int(arg)
 			else:
 				assert False, "Unhandled option %r"%opt
 
@@ -178,6 +497,12 @@ class parseArgs():
 			self.display_help("Must provide reference FASTA file <-r,--ref")
 		if not self.pileup:
 			self.display_help("Must provide mpilup output <-m,--mpileup>")
+		if self.bgzip and not self.out and not self.per_sample:
+			self.display_help("Must provide output file <-o,--out> to use -z,--bgzip")
+		if self.stream and len(self.pileup) > 1 and not self.per_sample:
+			self.display_help("--stream with multiple samples requires --per-sample")
+		if self.per_sample and len(self.pileup) < 2:
+			self.display_help("--per-sample requires one mpileup per sample <-m,--mpileup>")
 
 
 	def display_help(self, message=None):
@@ -192,9 +517,20 @@ class parseArgs():
 	Arguments:
 		-r,--ref	: Reference genome file (FASTA)
 		-v,--vcf	: VCF file containing genotypes
+		  		  All inputs may be plain, gzip or bgzip-compressed
 		-m,--mpileup	: Samtools mpileup file for ALL sites (-aa option in mpileup)
+		  		  Repeat for multi-sample mode: one file per sample, named as
+		  		  <sample>.*, using each sample's own genotypes from the VCF
 		-c,--cov	: Minimum coverage (taken from mpileup) to call, otherwise write "N"
-		-s,--sample	: Output sample name (default="sample")
+		-s,--sample	: Output sample name (default="sample"; single-sample mode)
+		-o,--out	: Output FASTA file (default: write to stdout)
+		  		  With --per-sample, the output directory (default=.)
+		--per-sample	: In multi-sample mode, write <sample>.fasta per sample
+		--stream	: Stream all inputs together instead of loading them into
+		  		  memory. Inputs must be sorted in reference contig order
+		-w,--width	: Line width of output FASTA, 0 for no wrapping (default=60)
+		-z,--bgzip	: Write bgzip-compressed output, with .fai and .gzi indexes
+		-t,--threads	: Threads for decompressing bgzipped inputs (default=1)
 		-h,--help	: Displays help menu
 """)
 		print()
@@ -0,0 +1,707 @@
+#!/usr/bin/python
+
+import sys
+import os
+import getopt
+import random
+import shutil
+import tempfile
+import subprocess
+import pysam
+
+#Differential correctness harness for vcf2msa.py: generates small random
+#VCF/FASTA/mpileup cases, builds the alignments with the original
+#vcf2msa.py (kept unchanged in test/baseline), and checks that every
+#vcf2msa.py engine (see ENGINES) writes identical alignment files
+
+VCF2MSA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vcf2msa.py")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test", "baseline", "vcf2msa.py")
+BASES = "ACGT"
+
+#Offline stand-in for Clustal Omega: vcf2msa.py pads sequences to equal
+#length before aligning, so echoing the input gives a valid alignment
+CLUSTALO_STUB = """#!/usr/bin/env python3
+import sys
+sys.stdout.write(sys.stdin.read())
+"""
+
+#Clustal Omega stand-in that always fails, and how long vcf2msa.py may take
+#to give up on it (it must exit with an error, not hang or succeed)
+FAILING_CLUSTALO_STUB = """#!/usr/bin/env python3
+import sys
+sys.stdin.read()
+sys.exit(3)
+"""
+FAILING_TIMEOUT = 120
+#Loci in the failing-clustalo case: enough to fill the pipeline queues
+FAILING_LOCI = 30
+
+#Call filter check: per-sample GQ/DP fields with no ##FORMAT header line,
+#missing (".", dropped) and multi-valued entries, and the alignments expected
+#with --min-gq 20 --min-call-dp 5 (failing calls become N, missing pass)
+FILTER_REF = "ACGTACGTAC"
+FILTER_RECORDS = [
+	("2", "C", "T", "GT:GQ:DP", ["1/1:30:10", "1/1:5:10", "1/1:.:."]),
+	("4", "T", "G", "GT:DP:GQ", ["1/1:2:50", "1/1", "1/1:8,9:40"]),
+	("6", "C", "A", "GT:GQ", ["0/1:25", "1/1:19.5", "0/0:20"]),
+]
+FILTER_EXPECTED = {"s1": "ATGNAMGTAC", "s2": "ANGGANGTAC", "s3": "ATGGACGTAC"}
+
+#Sample added to the VCF, then left out with --exclude-samples
+EXTRA_SAMPLE = "zzextra"
+
+#Thresholds of the filters engine (random GQ and DP values are 0-60)
+MIN_GQ = 20
+MIN_CALL_DP = 10
+
+#Ways of running vcf2msa.py that must match the original vcf2msa.py
+#Each takes a case and returns extra command-line arguments; it may also
+#rewrite the case's inputs (e.g. compress or split them) in its own copy,
+#set the inputs the original is run on instead (case["reference"]), or ask
+#for the --stats table to be checked (case["stats"])
+def engine_default(case):
+	return(list())
+
+def engine_split(case):
+	#one VCF per contig, processed in parallel
+	args = ["-p", "2"]
+	vcfs = split_vcf(case)
+	case["vcf_args"] = vcfs
+	return(args)
+
+def engine_threads(case):
+	#bgzipped reference and mpileups, with threaded decompression
+	case["ref"] = bgzip(case["ref"])
+	case["mpileup"] = [bgzip(m) for m in case["mpileup"]]
+	return(["-t", "2"])
+
+def engine_memory(case):
+	#a budget too small for anything: smallest chunks, loci spilled to disk
+	return(["--max-memory", "1M"])
+
+def engine_serial(case):
+	#one alignment at a time, so the pipeline stages take turns
+	return(["--align-jobs", "1"])
+
+def engine_samples(case):
+	#an extra sample (with its own indels and mpileup) that is excluded
+	with pysam.BGZFile(case["vcf"], "rb") as fh:
+		lines = fh.read().decode().splitlines()
+	out = list()
+	for line in lines:
+		if line.startswith("##"):
+			out.append(line)
+		elif line.startswith("#"):
+			out.append(line + "\t" + EXTRA_SAMPLE)
+		else:
+			out.append(line + "\t" + line.rsplit("\t", 1)[-1])
+	f = case["vcf"][:-len(".vcf.gz")] + ".extra.vcf"
+	with open(f, "w") as fh:
+		fh.write("\n".join(out) + "\n")
+	case["vcf_args"] = [pysam.tabix_index(f, preset="vcf", force=True)]
+	if case["mpileup"]:
+		m = os.path.join(os.path.dirname(f), EXTRA_SAMPLE + ".mpileup")
+		shutil.copyfile(case["mpileup"][0], m)
+		case["mpileup"].append(m)
+	exclude = os.path.join(os.path.dirname(f), "exclude.txt")
+	with open(exclude, "w") as fh:
+		fh.write(EXTRA_SAMPLE + "\n")
+	return(["--exclude-samples", exclude])
+
+def engine_filters(case):
+	#calls below MIN_GQ/MIN_CALL_DP masked as they are decoded; the original
+	#gets the same result from a VCF with those genotypes set missing and
+	#zero-depth mpileup lines at their positions
+	with pysam.BGZFile(case["vcf"], "rb") as fh:
+		lines = fh.read().decode().splitlines()
+	owners = None
+	masked = dict()
+	out = list()
+	for line in lines:
+		if line.startswith("##"):
+			out.append(line)
+			continue
+		fields = line.split("\t")
+		if line.startswith("#"):
+			owners = [c.split(".")[0] for c in fields[9:]]
+			out.append(line)
+			continue
+		fmt = fields[8].split(":")
+		for j, call in enumerate(fields[9:]):
+			vals = call.split(":")
+			if failed_call(fmt, vals):
+				vals[0] = "./."
+				masked.setdefault(owners[j], list()).append((fields[0], fields[1]))
+			fields[9 + j] = ":".join(vals)
+		out.append("\t".join(fields))
+	d = os.path.join(os.path.dirname(case["vcf"]), "filters")
+	os.makedirs(d, exist_ok=True)
+	ref = dict(case)
+	with open(os.path.join(d, "calls.vcf"), "w") as fh:
+		fh.write("\n".join(out) + "\n")
+	ref["vcf"] = pysam.tabix_index(os.path.join(d, "calls.vcf"), preset="vcf", force=True)
+	ref["mpileup"] = list()
+	mpileups = dict((os.path.basename(m).split(".")[0], m) for m in case["mpileup"])
+	for samp in sorted(set(mpileups) | set(masked)):
+		f = os.path.join(d, samp + ".mpileup")
+		with open(f, "w") as fh:
+			if samp in mpileups:
+				with open(mpileups[samp]) as src:
+					fh.write(src.read())
+			for chrom, pos in masked.get(samp, list()):
+				fh.write("%s\t%s\tN\t0\t.\t.\n"%(chrom, pos))
+		ref["mpileup"].append(f)
+	case["reference"] = ref
+	return(["--min-gq", str(MIN_GQ), "--min-call-dp", str(MIN_CALL_DP)])
+
+#Whether a call fails MIN_GQ or MIN_CALL_DP: missing values pass
+def failed_call(fmt, vals):
+	for field, minimum in (("GQ", MIN_GQ), ("DP", MIN_CALL_DP)):
+		if field in fmt:
+			i = fmt.index(field)
+			if i < len(vals) and vals[i] not in ("", ".") and float(vals[i]) < minimum:
+				return(True)
+	return(False)
+
+def engine_stats(case):
+	#per-locus statistics, checked against those of the expected alignments
+	case["stats"] = "stats.tsv"
+	return(["--stats", case["stats"]])
+
+ENGINES = {
+	"default": engine_default,
+	"split": engine_split,
+	"threads": engine_threads,
+	"memory": engine_memory,
+	"serial": engine_serial,
+	"samples": engine_samples,
+	"filters": engine_filters,
+	"stats": engine_stats,
+}
+
+def main():
+	params = parseArgs()
+
+	#vcf2msa.py picks among equally short indel alleles in set order, so
+	#string hashing must be reproducible across the processes compared
+	if os.environ.get("PYTHONHASHSEED") != "0":
+		os.environ["PYTHONHASHSEED"] = "0"
+		os.execv(sys.executable, [sys.executable] + sys.argv)
+
+	engines = params.engines or list(ENGINES.keys())
+	for e in engines:
+		if e not in ENGINES:
+			print("Unknown engine:", e)
+			print("Available engines:", ", ".join(ENGINES.keys()))
+			sys.exit(1)
+
+	work = tempfile.mkdtemp(prefix="checkEngines.")
+	env = dict(os.environ)
+	if not params.clustalo:
+		stub = os.path.join(work, "bin")
+		os.makedirs(stub)
+		with open(os.path.join(stub, "clustalo"), "w") as fh:
+			fh.write(CLUSTALO_STUB)
+		os.chmod(os.path.join(stub, "clustalo"), 0o755)
+		env["PATH"] = stub + os.pathsep + env.get("PATH", "")
+
+	failed = 0
+	try:
+		for i in range(params.cases):
+			seed = params.seed + i
+			case_dir = os.path.join(work, "case%d"%seed)
+			case = make_case(case_dir, random.Random(seed))
+			#outputs of the original, by the inputs it was run on
+			expected = dict()
+			bad = list()
+			for e in engines:
+				out = os.path.join(case_dir, e)
+				got, ecase = run_engine(e, case, out, env)
+				ref = ecase.get("reference", case)
+				key = (ref["vcf"],) + tuple(ref["mpileup"])
+				if key not in expected:
+					expected[key] = run_reference(ref, os.path.join(case_dir, "reference%d"%len(expected)), env)
+				want = expected[key]
+				if ecase.get("stats"):
+					want = dict(want)
+					want["stats"] = ref_stats(want)
+				if got != want:
+					bad.append(e)
+					describe_diff(e, want, got)
+			if bad:
+				failed += 1
+				print("Case %d (seed %d) FAILED for: %s"%(i + 1, seed, ", ".join(bad)))
+				if params.keep:
+					dest = os.path.join(params.keep, "case%d"%seed)
+					shutil.rmtree(dest, ignore_errors=True)
+					shutil.copytree(case_dir, dest)
+					print("\tInputs and outputs kept in", dest)
+			elif params.verbose:
+				print("Case %d (seed %d) ok: %d loci, %d records"%(i + 1, seed, len(case["loci"]), case["records"]))
+			shutil.rmtree(case_dir, ignore_errors=True)
+		failing_ok = check_failing_clustalo(os.path.join(work, "failing"), env)
+		filters_ok = check_call_filters(os.path.join(work, "filters"), env)
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+
+	print("%d of %d cases passed for engines: %s"%(params.cases - failed, params.cases, ", ".join(engines)))
+	if not failing_ok:
+		print("Failing clustalo check FAILED")
+	if not filters_ok:
+		print("Call filter check FAILED")
+	if failed or not failing_ok or not filters_ok:
+		sys.exit(1)
+
+#Check that vcf2msa.py exits with an error, rather than hanging or writing
+#alignments, when clustalo fails: FAILING_LOCI small loci, each with an
+#insertion, are aligned with a clustalo that always exits non-zero
+def check_failing_clustalo(case_dir, env):
+	os.makedirs(os.path.join(case_dir, "bin"))
+	stub = os.path.join(case_dir, "bin", "clustalo")
+	with open(stub, "w") as fh:
+		fh.write(FAILING_CLUSTALO_STUB)
+	os.chmod(stub, 0o755)
+	env = dict(env)
+	env["PATH"] = os.path.dirname(stub) + os.pathsep + env.get("PATH", "")
+
+	seq = "".join(BASES[i % 4] for i in range(FAILING_LOCI * 20))
+	ref = os.path.join(case_dir, "ref.fasta")
+	with open(ref, "w") as fh:
+		fh.write(">c1\n%s\n"%seq)
+	vcf_file = os.path.join(case_dir, "calls.vcf")
+	with open(vcf_file, "w") as fh:
+		fh.write("##fileformat=VCFv4.2\n")
+		fh.write("##contig=<ID=c1,length=%d>\n"%len(seq))
+		fh.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+		fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n")
+		for i in range(FAILING_LOCI):
+			pos = i * 20 + 10
+			fh.write("c1\t%d\t.\t%s\t%sTT\t.\tPASS\t.\tGT\t1/1\t0/0\n"%(pos, seq[pos - 1], seq[pos - 1]))
+	vcf_gz = pysam.tabix_index(vcf_file, preset="vcf", force=True)
+	regfile = os.path.join(case_dir, "regions.txt")
+	with open(regfile, "w") as fh:
+		for i in range(FAILING_LOCI):
+			fh.write("g%d@c1:%d-%d\n"%(i + 1, i * 20 + 1, i * 20 + 20))
+
+	out = os.path.join(case_dir, "out")
+	os.makedirs(out)
+	cmd = [sys.executable, VCF2MSA, "-f", ref, "-v", vcf_gz, "-R", regfile]
+	try:
+		proc = subprocess.run(cmd, cwd=out, env=env, stdout=subprocess.PIPE,
+			stderr=subprocess.STDOUT, timeout=FAILING_TIMEOUT)
+	except subprocess.TimeoutExpired:
+		print("\tfailing clustalo: vcf2msa.py still running after %d s"%FAILING_TIMEOUT)
+		return(False)
+	if proc.returncode == 0:
+		print("\tfailing clustalo: vcf2msa.py exited successfully")
+		return(False)
+	return(True)
+
+#Check --min-gq/--min-call-dp on FILTER_RECORDS against FILTER_EXPECTED
+def check_call_filters(case_dir, env):
+	os.makedirs(case_dir)
+	ref = os.path.join(case_dir, "ref.fasta")
+	with open(ref, "w") as fh:
+		fh.write(">c1\n%s\n"%FILTER_REF)
+	vcf_file = os.path.join(case_dir, "calls.vcf")
+	with open(vcf_file, "w") as fh:
+		fh.write("##fileformat=VCFv4.2\n")
+		fh.write("##contig=<ID=c1,length=%d>\n"%len(FILTER_REF))
+		fh.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+		fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(sorted(FILTER_EXPECTED)) + "\n")
+		for pos, r, alt, fmt, calls in FILTER_RECORDS:
+			fh.write("\t".join(["c1", pos, ".", r, alt, "50", "PASS", ".", fmt] + calls) + "\n")
+	vcf_gz = pysam.tabix_index(vcf_file, preset="vcf", force=True)
+	regfile = os.path.join(case_dir, "regions.txt")
+	with open(regfile, "w") as fh:
+		fh.write("g1@c1:1-%d\n"%(len(FILTER_REF) + 1))
+
+	out = os.path.join(case_dir, "out")
+	os.makedirs(out)
+	cmd = [sys.executable, VCF2MSA, "-f", ref, "-v", vcf_gz, "-R", regfile,
+		"--min-gq", "20", "--min-call-dp", "5"]
+	proc = subprocess.run(cmd, cwd=out, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	if proc.returncode != 0:
+		print("\tcall filters: vcf2msa.py exited with status %d:"%proc.returncode)
+		print(proc.stdout.decode())
+		return(False)
+	expected = "".join(">c1:1-%d_%s\n%s\n"%(len(FILTER_REF) + 1, samp, seq)
+		for samp, seq in sorted(FILTER_EXPECTED.items()))
+	got = read_outputs(out).get("g1.fasta")
+	if got != expected:
+		print("\tcall filters: expected\n%s\tgot\n%s"%(expected, got))
+		return(False)
+	return(True)
+
+############################## Case generation ##############################
+
+#Generate a random case in case_dir: reference FASTA, bgzipped and indexed
+#VCF, per-sample mpileups and a regions file, plus vcf2msa.py options
+def make_case(case_dir, rng):
+	os.makedirs(case_dir)
+	case = dict()
+
+	#reference, occasionally with soft-masked (lowercase) stretches
+	contigs = list()
+	for c in range(rng.randint(1, 3)):
+		seq = [rng.choice(BASES) for _ in range(rng.randint(30, 120))]
+		if rng.random() < 0.3:
+			s = rng.randrange(len(seq))
+			for p in range(s, min(len(seq), s + rng.randint(1, 10))):
+				seq[p] = seq[p].lower()
+		contigs.append(("c%d"%(c + 1), "".join(seq)))
+	case["ref"] = os.path.join(case_dir, "ref.fasta")
+	with open(case["ref"], "w") as fh:
+		for name, seq in contigs:
+			fh.write(">%s\n%s\n"%(name, seq))
+
+	#samples, some with a second (e.g. indel) VCF column for the same sample
+	samples = ["s%d"%(i + 1) for i in range(rng.randint(2, 5))]
+	columns = list()
+	owners = list()
+	for i, s in enumerate(samples):
+		columns.append(s + ".snps")
+		owners.append(i)
+		if rng.random() < 0.3:
+			columns.append(s + ".indels")
+			owners.append(i)
+
+	#the original vcf2msa.py crashes on a contig without records, and on
+	#merging two calls of a sample at one position into an ambiguity code,
+	#so every contig has records, and a sample has one call per position
+	rows = list()
+	for name, seq in contigs:
+		for pos in sorted(rng.sample(range(len(seq)), rng.randint(1, max(1, len(seq) // 3)))):
+			called = set()
+			for _ in range(2 if rng.random() < 0.1 else 1):
+				rows.append(make_record(rng, name, seq, pos, owners, called))
+	case["records"] = len(rows)
+	vcf_file = os.path.join(case_dir, "calls.vcf")
+	with open(vcf_file, "w") as fh:
+		fh.write("##fileformat=VCFv4.2\n")
+		for name, seq in contigs:
+			fh.write("##contig=<ID=%s,length=%d>\n"%(name, len(seq)))
+		fh.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+		#GQ and DP are declared in some cases only
+		if rng.random() < 0.5:
+			fh.write('##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">\n')
+			fh.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+		fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(columns) + "\n")
+		for row in rows:
+			fh.write("\t".join(row) + "\n")
+	case["vcf"] = pysam.tabix_index(vcf_file, preset="vcf", force=True)
+	case["vcf_args"] = [case["vcf"]]
+
+	#mpileups for some samples, with some positions missing
+	case["mpileup"] = list()
+	case["cov"] = rng.randint(1, 3)
+	for s in samples:
+		if rng.random() < 0.3:
+			continue
+		f = os.path.join(case_dir, s + ".mpileup")
+		with open(f, "w") as fh:
+			for name, seq in contigs:
+				for p, b in enumerate(seq):
+					if rng.random() < 0.05:
+						continue
+					fh.write("%s\t%d\t%s\t%d\t.\t.\n"%(name, p + 1, b.upper(), rng.randint(0, 5)))
+		case["mpileup"].append(f)
+
+	#loci, possibly overlapping, adjacent, or out of bounds (whole contig);
+	#some share the gene name (so the output file) of an earlier locus
+	case["loci"] = list()
+	for i in range(rng.randint(1, 6)):
+		name, seq = rng.choice(contigs)
+		start = rng.randint(1, len(seq))
+		end = min(len(seq), start + rng.randint(0, 40))
+		if rng.random() < 0.1:
+			end = len(seq) + 5
+		gene = i + 1
+		if i and rng.random() < 0.4:
+			gene = rng.randint(1, i)
+		case["loci"].append("g%d@%s:%d-%d"%(gene, name, start, end))
+	case["regfile"] = os.path.join(case_dir, "regions.txt")
+	with open(case["regfile"], "w") as fh:
+		fh.write("\n".join(case["loci"]) + "\n")
+
+	case["indel"] = rng.random() < 0.5
+	return(case)
+
+#Make one VCF row at 0-based pos: SNPs, multiallelics, "*" alleles,
+#insertions and deletions (which may overlap later records), with GQ and
+#DP values (some missing) for some records. owners gives the sample of each
+#column; samples in called already have a call at pos, and get none
+def make_record(rng, name, seq, pos, owners, called):
+	ref = seq[pos].upper()
+	kind = rng.choice(["snp", "snp", "multi", "star", "ins", "del"])
+	others = [b for b in BASES if b != ref]
+	if kind == "snp":
+		alts = [rng.choice(others)]
+	elif kind == "multi":
+		alts = rng.sample(others, rng.randint(2, 3))
+	elif kind == "star":
+		alts = [rng.choice(others), "*"]
+	elif kind == "ins":
+		alts = [ref + "".join(rng.choice(BASES) for _ in range(rng.randint(1, 4)))]
+		if rng.random() < 0.5:
+			alts.append(rng.choice(others))
+	else:
+		end = min(len(seq), pos + 1 + rng.randint(1, 4))
+		if end == pos + 1:
+			alts = [rng.choice(others)]
+		else:
+			ref = seq[pos:end].upper()
+			alts = [ref[0]]
+			if rng.random() < 0.5:
+				alts.append(ref[0] + ref[2:])
+	fmt = rng.choice(["GT", "GT", "GT:GQ:DP", "GT:DP:GQ", "GT:GQ", "GT:DP"])
+	calls = list()
+	for owner in owners:
+		r = rng.random()
+		if owner in called or r < 0.15:
+			gt = "./."
+		elif r < 0.2:
+			gt = "."
+		elif r < 0.25:
+			gt = str(rng.randint(0, len(alts)))
+		else:
+			sep = "|" if rng.random() < 0.2 else "/"
+			gt = "%d%s%d"%(rng.randint(0, len(alts)), sep, rng.randint(0, len(alts)))
+		if gt not in ("./.", "."):
+			called.add(owner)
+		fields = [gt]
+		for f in fmt.split(":")[1:]:
+			fields.append("." if rng.random() < 0.1 else str(rng.randint(0, 60)))
+		#trailing fields may be dropped
+		if rng.random() < 0.1:
+			fields = fields[:1]
+		calls.append(":".join(fields))
+	return([name, str(pos + 1), ".", ref, ",".join(alts), "50", "PASS", ".", fmt] + calls)
+
+#Split a case's VCF into one bgzipped, indexed VCF per contig
+def split_vcf(case):
+	header = list()
+	body = dict()
+	with pysam.BGZFile(case["vcf"], "rb") as fh:
+		for line in fh.read().decode().splitlines(True):
+			if line.startswith("#"):
+				header.append(line)
+			else:
+				body.setdefault(line.split("\t", 1)[0], list()).append(line)
+	vcfs = list()
+	base = case["vcf"][:-len(".vcf.gz")]
+	for contig, lines in body.items():
+		f = "%s.%s.vcf"%(base, contig)
+		with open(f, "w") as fh:
+			fh.write("".join(header + lines))
+		vcfs.append(pysam.tabix_index(f, preset="vcf", force=True))
+	return(vcfs or [case["vcf"]])
+
+#bgzip a file, returning the new file name
+def bgzip(f):
+	pysam.tabix_compress(f, f + ".gz", force=True)
+	return(f + ".gz")
+
+################################# Engines ###################################
+
+#Run vcf2msa.py as the named engine, returning {file name: contents} (with
+#the --stats table, if checked, as "stats") and the engine's copy of the case
+def run_engine(name, case, out, env):
+	case = dict(case)
+	case["mpileup"] = list(case["mpileup"])
+	os.makedirs(out)
+	extra = ENGINES[name](case)
+	cmd = [sys.executable, VCF2MSA, "-f", case["ref"], "-R", case["regfile"]]
+	for v in case["vcf_args"]:
+		cmd.extend(["-v", v])
+	for m in case["mpileup"]:
+		cmd.extend(["-m", m])
+	if case["mpileup"]:
+		cmd.extend(["-c", str(case["cov"])])
+	if case["indel"]:
+		cmd.append("--indel")
+	cmd.extend(extra)
+	proc = subprocess.run(cmd, cwd=out, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	if proc.returncode != 0:
+		print("Engine %s exited with status %d:"%(name, proc.returncode))
+		print(proc.stdout.decode())
+	got = read_outputs(out)
+	if case.get("stats"):
+		got["stats"] = read_stats(os.path.join(out, case["stats"]))
+	return(got, case)
+
+#Read a --stats table, with its rows sorted: loci of different genes may
+#be written in any order
+def read_stats(f):
+	if not os.path.exists(f):
+		return(None)
+	with open(f) as fh:
+		lines = fh.read().splitlines()
+	return("\n".join(lines[:1] + sorted(lines[1:])) + "\n")
+
+#Read every alignment file written to a directory
+def read_outputs(out):
+	ret = dict()
+	for f in sorted(os.listdir(out)):
+		if f.endswith(".fasta"):
+			with open(os.path.join(out, f)) as fh:
+				ret[f] = fh.read()
+	return(ret)
+
+#Print the first difference between two sets of outputs
+def describe_diff(name, expected, got):
+	for f in sorted(set(expected) | set(got)):
+		if f not in got:
+			print("\t%s: missing %s"%(name, f))
+		elif f not in expected:
+			print("\t%s: unexpected %s"%(name, f))
+		elif expected[f] != got[f]:
+			a = expected[f].splitlines()
+			b = got[f].splitlines()
+			for i in range(max(len(a), len(b))):
+				la = a[i] if i < len(a) else "<EOF>"
+				lb = b[i] if i < len(b) else "<EOF>"
+				if la != lb:
+					print("\t%s: %s line %d differs:\n\t\texpected: %s\n\t\tgot:      %s"%(name, f, i + 1, la, lb))
+					break
+		else:
+			continue
+		return
+
+############################# Reference engine ##############################
+
+#Build the alignments for a case with the original vcf2msa.py, returning
+#{file name: contents}
+def run_reference(case, out, env):
+	os.makedirs(out)
+	cmd = [sys.executable, BASELINE, "-f", case["ref"], "-v", case["vcf"], "-R", case["regfile"]]
+	for m in case["mpileup"]:
+		cmd.extend(["-m", m])
+	if case["mpileup"]:
+		cmd.extend(["-c", str(case["cov"])])
+	if case["indel"]:
+		cmd.append("--indel")
+	proc = subprocess.run(cmd, cwd=out, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	if proc.returncode != 0:
+		print("Original vcf2msa.py exited with status %d:"%proc.returncode)
+		print(proc.stdout.decode())
+	return(read_outputs(out))
+
+#IUPAC codes counted as alleles by --stats: bases and two-base ambiguities
+STATS_BASES = {"A":"A", "C":"C", "G":"G", "T":"T", "R":"AG", "Y":"CT",
+	"S":"CG", "W":"AT", "K":"GT", "M":"AC"}
+
+#The --stats table expected for a set of alignment files, as read_stats()
+#returns it: length, variable and parsimony-informative sites, gap fraction
+#and per-sample N fraction of each locus (a block of one record per sample)
+def ref_stats(outputs):
+	samples = list()
+	loci = list()
+	for f in sorted(outputs):
+		records = outputs[f].splitlines()
+		for i in range(0, len(records), 2):
+			locus, samp = records[i][1:].rsplit("_", 1)
+			if samp not in samples:
+				samples.append(samp)
+			if not loci or loci[-1][0] != f or samp in loci[-1][2]:
+				loci.append((f, locus, dict()))
+			loci[-1][2][samp] = records[i + 1]
+	lines = list()
+	for f, locus, seqs in loci:
+		contig, span = locus.rsplit(":", 1)
+		start, end = span.split("-")
+		seqs = [seqs[samp] for samp in samples]
+		length = max(len(seq) for seq in seqs)
+		variable = 0
+		informative = 0
+		for j in range(length):
+			counts = dict()
+			for seq in seqs:
+				for b in STATS_BASES.get(seq[j].upper(), ""):
+					counts[b] = counts.get(b, 0) + 1
+			variable += len(counts) >= 2
+			informative += sum(1 for c in counts.values() if c >= 2) >= 2
+		row = [f[:-len(".fasta")], contig, start, end, str(length), str(variable), str(informative)]
+		cells = length * len(samples)
+		row.append("%.4f"%(sum(seq.count("-") for seq in seqs) / cells) if cells else "NA")
+		for seq in seqs:
+			row.append("%.4f"%((seq.count("N") + seq.count("n")) / length) if length else "NA")
+		lines.append("\t".join(row))
+	header = ["locus", "contig", "start", "end", "length", "variable_sites",
+		"informative_sites", "gap_fraction"] + ["missing_" + samp for samp in samples]
+	return("\n".join(["\t".join(header)] + sorted(lines)) + "\n")
+
+#Object to parse command-line arguments
+class parseArgs():
+	def __init__(self):
+		#Define options
+		try:
+			options, remainder = getopt.getopt(sys.argv[1:], 'n:s:e:k:hV', \
+			["cases=", "seed=", "engines=", "keep=", "clustalo", "verbose", "help"])
+		except getopt.GetoptError as err:
+			print(err)
+			self.display_help("\nExiting because getopt returned non-zero exit status.")
+		#Default values for params
+		self.cases=50
+		self.seed=1
+		self.engines=None
+		self.keep=None
+		self.clustalo=False
+		self.verbose=False
+
+		#First pass to see if help menu was called
+		for o, a in options:
+			if o in ("-h", "-help", "--help"):
+				self.display_help("Exiting because help menu was called.")
+
+		#Second pass to set all args.
+		for opt, arg_raw in options:
+			arg = arg_raw.replace(" ","")
+			arg = arg.strip()
+			opt = opt.lstrip("-")
+			if opt in ('n', 'cases'):
+				self.cases=int(arg)
+			elif opt in ('s', 'seed'):
+				self.seed=int(arg)
+			elif opt in ('e', 'engines'):
+				self.engines=[e for e in arg.split(",") if e]
+			elif opt in ('k', 'keep'):
+				self.keep=os.path.abspath(arg)
+			elif opt == 'clustalo':
+				self.clustalo=True
+			elif opt in ('V', 'verbose'):
+				self.verbose=True
+			elif opt in ('h', 'help'):
+				pass
+			else:
+				assert False, "Unhandled option %r"%opt
+
+		if self.cases < 1:
+			self.display_help("Number of cases must be positive")
+
+	def display_help(self, message=None):
+		if message is not None:
+			print()
+			print (message)
+		print ("\ncheckEngines.py\n")
+		print ("\nUsage: ", sys.argv[0], "-n <50> -s <1>\n")
+		print ("Description: Checks that vcf2msa.py engines reproduce the reference implementation on random cases")
+
+		print("""
+	Arguments:
+		-n,--cases	: Number of random cases to generate [default=50]
+		-s,--seed	: Seed of the first case (case i uses seed+i) [default=1]
+		-e,--engines	: Comma-separated engines to check [default=all]
+		  		  (%s)
+		-k,--keep	: Directory to keep inputs and outputs of failing cases
+		--clustalo	: Use clustalo from PATH instead of the offline stub
+		-V,--verbose	: Report every case
+		-h,--help	: Displays help menu
+
+"""%", ".join(ENGINES.keys()))
+		print()
+		sys.exit()
+
+#Call main function
+if __name__ == '__main__':
+    main()
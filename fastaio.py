@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+#Shared input reading for the vcf2msa scripts
+#Inputs may be plain text, gzip or BGZF (detected from the file contents).
+#BGZF inputs can be decompressed on several threads: pysam doesn't expose
+#htslib threads for plain sequential reads, so BGZF blocks (which are
+#independent deflate streams) are inflated on a thread pool instead, in
+#parallel with the caller decoding the previous blocks
+
+import io
+import gzip
+import zlib
+import struct
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#Number of BGZF blocks inflated per task, and tasks queued per thread
+BGZF_BATCH = 16
+BGZF_AHEAD = 4
+#Read buffer for decompressed input
+READ_BUFFER = 1 << 20
+
+#Open a file for reading, decompressing gzip/BGZF transparently
+#	threads: threads used to inflate BGZF input (gzip is always single-threaded)
+#	text: return a text stream instead of bytes
+def open_input(f, threads=1, text=False):
+	fh = open(f, 'rb')
+	magic = fh.peek(18)[:18]
+	if magic[:2] == b"\x1f\x8b":
+		fh.close()
+		if threads > 1 and is_bgzf(magic):
+			fh = io.BufferedReader(BGZFReader(f, threads), READ_BUFFER)
+		else:
+			fh = gzip.open(f, 'rb')
+	if text:
+		return(io.TextIOWrapper(fh))
+	return(fh)
+
+#Check if the start of a file is a BGZF block header: gzip with an extra
+#field whose first subfield is "BC"
+def is_bgzf(header):
+	return(len(header) >= 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC")
+
+#Inflate a batch of raw BGZF blocks, checking their CRC and size
+def inflate_blocks(blocks):
+	out = list()
+	for cdata, crc, size in blocks:
+		data = zlib.decompress(cdata, -15)
+		if len(data) != size or zlib.crc32(data) != crc:
+			raise IOError("Corrupt BGZF block")
+		out.append(data)
+	return(b"".join(out))
+
+#Read-only raw stream over a BGZF file, with blocks inflated on a thread
+#pool and returned in file order. Wrap in io.BufferedReader for lines.
+class BGZFReader(io.RawIOBase):
+	def __init__(self, f, threads):
+		self.name = f
+		self.fh = open(f, 'rb')
+		self.pool = ThreadPoolExecutor(threads)
+		self.ahead = threads * BGZF_AHEAD
+		self.pending = deque()
+		self.buffer = memoryview(b"")
+		self.eof = False
+
+	def readable(self):
+		return(True)
+
+	#Read the next raw block as (deflate data, crc32, size), or None at EOF
+	def read_block(self):
+		header = self.fh.read(12)
+		if not header:
+			return(None)
+		if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+			raise IOError("%s is not a valid BGZF file"%self.name)
+		xlen = struct.unpack("<H", header[10:12])[0]
+		extra = self.fh.read(xlen)
+		bsize = None
+		i = 0
+		while i + 4 <= len(extra):
+			slen = struct.unpack("<H", extra[i+2:i+4])[0]
+			if extra[i:i+2] == b"BC":
+				bsize = struct.unpack("<H", extra[i+4:i+6])[0]
+			i += 4 + slen
+		if bsize is None:
+			raise IOError("%s is not a valid BGZF file"%self.name)
+		rest = self.fh.read(bsize - xlen - 11)
+		if len(rest) != bsize - xlen - 11:
+			raise IOError("Truncated BGZF file %s"%self.name)
+		crc, size = struct.unpack("<II", rest[-8:])
+		return((rest[:-8], crc, size))
+
+	#Queue batches of blocks for inflating, up to the read-ahead limit
+	def fill(self):
+		while not self.eof and len(self.pending) < self.ahead:
+			blocks = list()
+			while len(blocks) < BGZF_BATCH:
+				block = self.read_block()
+				if block is None:
+					self.eof = True
+					break
+				blocks.append(block)
+			if blocks:
+				self.pending.append(self.pool.submit(inflate_blocks, blocks))
+
+	def readinto(self, b):
+		while not len(self.buffer):
+			self.fill()
+			if not self.pending:
+				return(0)
+			self.buffer = memoryview(self.pending.popleft().result())
+		n = min(len(b), len(self.buffer))
+		b[:n] = self.buffer[:n]
+		self.buffer = self.buffer[n:]
+		return(n)
+
+	def close(self):
+		if not self.closed:
+			self.pool.shutdown(wait=True, cancel_futures=True)
+			self.fh.close()
+		super().close()
+
+#Convert sequence bytes to the requested type: "str", "bytes" or "numpy"
+#("numpy" gives a read-only uint8 view of the bytes, without copying)
+def as_type(seq, mode):
+	if mode == "bytes":
+		return(seq)
+	elif mode == "numpy":
+		return(np.frombuffer(seq, dtype=np.uint8))
+	return(seq.decode())
+
+#Read genome as FASTA. This is a generator function, yielding
+#[header, sequence] for each record. Doesn't matter if sequences are
+#interleaved or not: lines are gathered and joined once per record.
+#	first_word: yield only the first word of the header (the sequence ID)
+#	mode: sequence type, "str" (default), "bytes" or "numpy"
+#	threads: threads used to inflate BGZF input
+def read_fasta(fas, first_word=False, mode="str", threads=1):
+	with open_input(fas, threads) as fh:
+		contig = None
+		lines = list()
+		for line in fh:
+			line = line.strip()
+			if not line:
+				continue
+			if line[:1] == b">": #Found a header line
+				#If we already loaded a contig, yield that contig and
+				#start loading a new one
+				if contig:
+					yield([contig, as_type(b"".join(lines), mode)])
+				contig = header_name(line, first_word)
+				lines = list()
+			else:
+				lines.append(line)
+		#yield last sequence, if it has both a header and sequence
+		if contig and lines:
+			yield([contig, as_type(b"".join(lines), mode)])
+
+#Read FASTA as a stream of (sequence ID, offset, sequence block) of about
+#<block> bases each, without holding any whole record in memory
+def stream_fasta(fas, block, mode="bytes", threads=1):
+	with open_input(fas, threads) as fh:
+		contig = None
+		offset = 0
+		lines = list()
+		size = 0
+		for line in fh:
+			line = line.strip()
+			if not line:
+				continue
+			if line[:1] == b">":
+				if lines:
+					yield(contig, offset, as_type(b"".join(lines), mode))
+				contig = header_name(line, True)
+				offset = 0
+				lines = list()
+				size = 0
+			else:
+				lines.append(line)
+				size += len(line)
+				if size >= block:
+					seq = b"".join(lines)
+					yield(contig, offset, as_type(seq, mode))
+					offset += len(seq)
+					lines = list()
+					size = 0
+		if lines:
+			yield(contig, offset, as_type(b"".join(lines), mode))
+
+#Get the name from a header line (bytes, including ">")
+def header_name(line, first_word=False):
+	name = line[1:].decode()
+	if first_word:
+		name = name.split()[0] if name.split() else ""
+	return(name)
@@ -4,63 +4,113 @@ import re
 import sys
 import os
 import getopt
+import multiprocessing
 import vcf
+import pysam
+import numpy as np
+from itertools import groupby, product
+from fastaio import open_input
+import nuccodec
+
+#Bases counted towards parsimony-informativeness: byte -> base mask, for
+#unambiguous A/C/G/T of either case (0 for anything else)
+BASE_MASKS = nuccodec.strict(nuccodec.ENCODE).tolist()
+#ALT alleles allowed in a SNP record (as in pyVCF's is_snp)
+SNP_ALLELES = set(["A", "C", "G", "T", "N", "*"])
+#Byte lookup tables for GT allele separators (unphased, phased), and for
+#bytes that end a GT field
+SEPARATORS = np.zeros(256, dtype=bool)
+SEPARATORS[[ord("/"), ord("|")]] = True
+GT_ENDS = np.zeros(256, dtype=bool)
+GT_ENDS[[ord(":"), ord("\t")]] = True
+#Byte lookup table for single-character alleles: digits to their value,
+#"." (missing) to -1, anything else to -2
+ALLELES = np.full(256, -2, dtype=np.int16)
+ALLELES[ord("0"):ord("9") + 1] = np.arange(10)
+ALLELES[ord(".")] = -1
+TAB = ord("\t")
+#Largest number of distinct calls (allele combinations) per record for
+#which samples are counted per call rather than one by one
+MAX_CALLS = 4096
+#Number of records tested together
+BLOCK_SIZE = 4096
 
 def main():
 	params = parseArgs()
 
-	vfh = vcf.Reader(open(params.vcf, 'r'))
+	vfh = vcf.Reader(filename=params.vcf)
 
 	#grab contig sizes
 	contigs = dict()
 	for c,s in vfh.contigs.items():
 		contigs[s.id] = s.length
 
-	regions = list()
+	#with a tabix index, each contig is scanned independently (in parallel
+	#with -p), and per-contig results are merged in header order
+	if has_index(params.vcf):
+		tbx = pysam.TabixFile(params.vcf)
+		indexed = set(tbx.contigs)
+		tbx.close()
+		order = [c for c in contigs if c in indexed]
+		order.extend(sorted(indexed - set(order)))
+		jobs = [(params.vcf, c, contigs.get(c), params.force, params.threads) for c in order]
+		if params.procs > 1 and len(jobs) > 1:
+			with multiprocessing.Pool(min(params.procs, len(jobs))) as pool:
+				results = pool.map(contig_breaks, jobs)
+		else:
+			results = [contig_breaks(job) for job in jobs]
+	else:
+		results = list()
+		with open_vcf(params.vcf, params.threads) as fh:
+			for chrom, records in groupby(scan_records(fh), key=lambda x: x[0]):
+				results.append(find_breaks(records, chrom, contigs.get(chrom), params.force))
 
-	this_chrom = None
-	start = int()
-	stop = int()
-	count = 0
-	for rec in vfh:
-		if not this_chrom:
-			this_chrom = rec.CHROM
-			start = 1
-			stop = 1
-			count = 0
-		#If we entered new chromosome, submit old break
-		elif this_chrom != rec.CHROM:
-			t = tuple([this_chrom, start, contigs[this_chrom]])
-			regions.append(t)
-			this_chrom = rec.CHROM
-			start = 1
-			stop = 1
-			count = 0
-
-		#if this SNP
-		if rec.is_snp and not rec.is_monomorphic:
-			#Check if parsimony-informative
-			if is_PIS(rec):
-				# g=list()
-				# for call in rec.samples:
-				# 	if call.gt_bases:
-				# 		g.append(call.gt_bases)
-				# print(g)
-				count+=1
-				#if this is the final PIS, submit region to list
-				if count == params.force:
-					stop = rec.POS
-					t = tuple([this_chrom, start, stop])
-					regions.append(t)
-					start = stop + 1
-					count = 0
-
-	t = tuple([this_chrom, start, contigs[this_chrom]])
-	regions.append(t)
+	regions = list()
+	for r in results:
+		regions.extend(r)
 
 	print("Writing regions to out.regions...")
 	write_regions("out.regions", regions)
 
+#Worker: find breaks for one contig of a tabix-indexed VCF
+def contig_breaks(job):
+	vcf_file, contig, length, force, threads = job
+	tbx = pysam.TabixFile(vcf_file, threads=threads)
+	try:
+		return(find_breaks(scan_records(tbx.fetch(contig)), contig, length, force))
+	finally:
+		tbx.close()
+
+#Break one chromosome into regions of <force> PIS each
+#records yields (chrom, pos, is_PIS) for this chromosome only
+#If the length is unknown (no ##contig length), the last region ends at
+#the last record
+def find_breaks(records, chrom, length, force):
+	regions = list()
+	start = 1
+	count = 0
+	pos = 0
+	for c, pos, pis in records:
+		#if this SNP is parsimony-informative
+		if pis:
+			count+=1
+			#if this is the final PIS, submit region to list
+			if count == force:
+				regions.append(tuple([chrom, start, pos]))
+				start = pos + 1
+				count = 0
+	if length is None:
+		print("Warning: no length for contig %s in VCF header, ending it at its last record (%d)"%(chrom,pos))
+		length = pos
+		if start > length:
+			return(regions)
+	regions.append(tuple([chrom, start, length]))
+	return(regions)
+
+#Check if a VCF file has a tabix (.tbi) or CSI index alongside it
+def has_index(f):
+	return(os.path.exists(f + ".tbi") or os.path.exists(f + ".csi"))
+
 #Function to write list of regions tuples, in GATK format
 def write_regions(f, r):
 
@@ -78,32 +128,154 @@ def write_regions(f, r):
 		finally:
 			fh.close()
 
+#Open a VCF as text, transparently handling gzip/bgzip compression
+#(bgzip is decompressed on <threads> threads)
+def open_vcf(f, threads=1):
+	return(open_input(f, threads, text=True))
+
+#Generator yielding (chrom, pos, is_PIS) for every record in VCF lines
+#The sample columns of SNP records are gathered in blocks, parsed in one
+#pass by parse_block() and tested together by pis_block()
+def scan_records(lines, block=BLOCK_SIZE):
+	buf = list()
+	cols = list()
+	codes = list()
+	for line in lines:
+		if line.startswith("#"):
+			continue
+		row = line.rstrip("\n").split("\t", 9)
+		snp = is_snp_row(row) and row[8].startswith("GT")
+		if snp:
+			cols.append(row[9])
+			codes.append(allele_codes(row[3], row[4].split(",")))
+		buf.append((row[0], int(row[1]), snp))
+		if len(buf) >= block:
+			yield from flush_block(buf, cols, codes)
+			buf, cols, codes = list(), list(), list()
+	yield from flush_block(buf, cols, codes)
+
+#Yield buffered records with their PIS status, in input order
+def flush_block(buf, cols, codes):
+	pis = iter(pis_block(parse_block(cols), codes) if cols else ())
+	for chrom, pos, snp in buf:
+		yield(chrom, pos, bool(next(pis)) if snp else False)
+
+#Parse the sample columns of a block of records into an allele index
+#matrix (records x samples x ploidy), missing alleles as -1. If every
+#record has the same number of samples, the columns are joined and parsed
+#as one, so the per-record cost is a few string operations
+def parse_block(cols):
+	samples = "\t".join(cols)
+	raw, starts = field_starts(samples)
+	#samples per record: fields starting between the record boundaries
+	bounds = np.cumsum([0] + [len(c) + 1 for c in cols])
+	if bounds[-1] == len(raw):
+		n = np.diff(np.searchsorted(starts, bounds))
+		if (n == n[0]).all():
+			gt = parse_fields(samples, raw, starts)
+			return(gt.reshape(len(cols), n[0], gt.shape[1]))
+	gts = [parse_gt(c) for c in cols]
+	ret = np.full((len(gts), max(g.shape[0] for g in gts), max(g.shape[1] for g in gts)), -1, dtype=np.int16)
+	for i, g in enumerate(gts):
+		ret[i, :g.shape[0], :g.shape[1]] = g
+	return(ret)
+
+#Equivalent of pyVCF rec.is_snp and not rec.is_monomorphic on a split VCF line
+def is_snp_row(row):
+	if len(row) < 10 or len(row[3]) > 1 or row[4] == ".":
+		return(False)
+	for a in row[4].split(","):
+		if a not in SNP_ALLELES:
+			return(False)
+	return(True)
+
+#Map each allele (REF first, then ALTs) to a base mask, or 0 if not A/C/G/T
+def allele_codes(ref, alts):
+	return([BASE_MASKS[ord(a)] if len(a) == 1 else 0 for a in [ref] + list(alts)])
+
+#Parse the sample columns of a VCF line into an integer allele index matrix
+#(samples x ploidy), with missing alleles as -1. GT must be the first FORMAT
+#field. Handles haploid, phased ("|") and unphased ("/") calls
+def parse_gt(samples):
+	raw, starts = field_starts(samples)
+	return(parse_fields(samples, raw, starts))
+
+#Bytes of tab-separated sample columns (with a closing tab), and the offset
+#at which each column starts
+def field_starts(samples):
+	raw = np.frombuffer(samples.encode() + b"\t", dtype=np.uint8)
+	starts = np.concatenate(([0], np.flatnonzero(raw == TAB)[:-1] + 1))
+	return(raw, starts)
+
+#Allele index matrix of the sample columns located by field_starts()
+def parse_fields(samples, raw, starts):
+	#fast paths for single-digit diploid and haploid calls, on the raw bytes
+	for width in (3, 1):
+		if starts[-1] + width >= len(raw):
+			continue
+		ok = GT_ENDS[raw[starts + width]]
+		if width == 3:
+			ok &= SEPARATORS[raw[starts + 1]]
+		if not ok.all():
+			continue
+		gt = np.empty((len(starts), (width + 1) // 2), dtype=np.int16)
+		for j in range(gt.shape[1]):
+			gt[:, j] = ALLELES[raw[starts + 2 * j]]
+		if (gt >= -1).all():
+			return(gt)
+	calls = [re.split(r"[/|]", f.split(":", 1)[0]) for f in samples.split("\t")]
+	ploidy = max(len(c) for c in calls)
+	ret = np.full((len(calls), ploidy), -1, dtype=np.int16)
+	for i, c in enumerate(calls):
+		for j, a in enumerate(c):
+			if a.isdigit():
+				ret[i, j] = int(a)
+	return(ret)
+
+#Test a block of records for parsimony-informative status
+#gts: (records x samples x ploidy) allele index matrix, as from parse_block()
+#codes: list of allele -> base mask lists, one per record
+#A sample contributes one count to each distinct A/C/G/T base in its call;
+#a site is PIS if at least two bases are each seen in two or more samples
+def pis_block(gts, codes):
+	r = len(codes)
+	a = max(len(c) for c in codes)
+	lookup = np.zeros((r, a + 1), dtype=np.uint8)
+	for i in range(r):
+		lookup[i, :len(codes[i])] = codes[i]
+	#out-of-range allele indices point at the trailing empty column (as
+	#unsigned, missing -1 is out of range too)
+	alleles = np.minimum(gts.view(np.uint16), a)
+	k = alleles.shape[2]
+	ncalls = (a + 1) ** k
+	if ncalls > MAX_CALLS:
+		#union of the bases in each sample's call, then samples per base
+		calls = nuccodec.union(lookup[np.arange(r)[:, None, None], alleles], axis=2)
+		return(nuccodec.variable(calls, axis=1, min_count=2))
+	#number each call by its alleles (as digits in base a + 1), count the
+	#samples with each call, and add up the bases of the calls
+	call = alleles[:, :, 0].astype(np.int64)
+	for j in range(1, k):
+		call = call * (a + 1) + alleles[:, :, j]
+	call += (np.arange(r) * ncalls)[:, None]
+	samples = np.bincount(call.ravel(), minlength=r * ncalls).reshape(r, ncalls)
+	digits = np.array(list(product(range(a + 1), repeat=k)), dtype=np.intp)
+	bits = np.unpackbits(nuccodec.union(lookup[:, digits], axis=2)[..., None], axis=-1, count=4, bitorder="little")
+	counts = np.einsum("rc,rcb->rb", samples, bits)
+	#as nuccodec.variable(): two bases each seen in two or more samples
+	return((counts >= 2).sum(axis=-1) >= 2)
+
 #Function to check pyVCF record for if parsimony informative or not
 def is_PIS(r):
-	counts = dict()
-	for sample in r.samples:
-		if sample.gt_bases:
-			nucs = [x.upper() for x in sample.gt_bases.split("/")]
-			if nucs[0] == nucs[1] and nucs[0] in ["A", "C", "G", "T"]:
-				if not nucs[0] in counts:
-					counts[nucs[0]] = 1
-				else:
-					counts[nucs[0]] += 1
-			else:
-				for a in nucs:
-					if a in ["A", "G", "C", "T"]:
-						if not a in counts:
-							counts[a] = 1
-						else:
-							counts[a] += 1
-	has_two = 0
-	if len(counts.keys()) > 1:
-		for key in counts.keys():
-			if counts[key] >= 2:
-				has_two += 1
-			if has_two >= 2:
-				return(True)
-	return(False)
+	calls = [c.gt_alleles if c.called else [None] for c in r.samples]
+	ploidy = max(len(c) for c in calls) if calls else 1
+	gt = np.full((len(calls), ploidy), -1, dtype=np.int16)
+	for i, c in enumerate(calls):
+		for j, a in enumerate(c):
+			if a is not None:
+				gt[i, j] = int(a)
+	codes = allele_codes(r.REF, [str(a) for a in r.ALT])
+	return(bool(pis_block(gt[None], [codes])[0]))
 
 
 
@@ -112,8 +284,8 @@ class parseArgs():
 	def __init__(self):
 		#Define options
 		try:
-			options, remainder = getopt.getopt(sys.argv[1:], 'v:f:h', \
-			["vcf=" "help", "force="])
+			options, remainder = getopt.getopt(sys.argv[1:], 'v:f:hp:t:', \
+			["vcf=", "help", "force=", "procs=", "threads="])
 		except getopt.GetoptError as err:
 			print(err)
 			self.display_help("\nExiting because getopt returned non-zero exit status.")
@@ -121,6 +293,8 @@ class parseArgs():
 		#Input params
 		self.vcf=None
 		self.force=100000
+		self.procs=1
+		self.threads=1
 
 		#First pass to see if help menu was called
 		for o, a in options:
@@ -137,6 +311,10 @@ class parseArgs():
 				self.vcf = arg
 			elif opt in ('f','force'):
 				self.force=int(arg)
+			elif opt in ('p','procs'):
+				self.procs=int(arg)
+			elif opt in ('t','threads'):
+				self.threads=int(arg)
 			elif opt in ('h', 'help'):
 				pass
 			else:
@@ -159,6 +337,9 @@ class parseArgs():
 	Arguments:
 		-v,--vcf	: VCF file for parsing
 		-f,--force	: Number of PIS to force a break
+		-p,--procs	: Number of worker processes for per-chromosome scanning
+		  		  (requires a bgzipped, tabix-indexed VCF) [default=1]
+		-t,--threads	: Decompression threads for a bgzipped VCF, per process [default=1]
 		-h,--help	: Displays help menu
 
 """)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+#Shared nucleotide codec for the vcf2msa scripts
+#Bases are held as bitmasks (A=1, C=2, G=4, T=8), so that an IUPAC
+#ambiguity code is the union of its bases (e.g. R = A|G = 5, N = 15), plus
+#flags for a gap and for lowercase (soft-masked) characters. Lookup tables
+#turn whole arrays of characters into masks and back, so that merging
+#genotypes and counting alleles become bitwise operations
+
+import numpy as np
+
+A = 1
+C = 2
+G = 4
+T = 8
+BASES = A | C | G | T
+GAP = 16
+LOWER = 32
+#Number of distinct masks (every combination of bases and flags)
+NMASKS = 64
+
+#IUPAC code of every combination of bases
+IUPAC = {
+	A: "A",
+	C: "C",
+	G: "G",
+	T: "T",
+	A | G: "R",
+	C | T: "Y",
+	C | G: "S",
+	A | T: "W",
+	G | T: "K",
+	A | C: "M",
+	C | G | T: "B",
+	A | G | T: "D",
+	A | C | T: "H",
+	A | C | G: "V",
+	BASES: "N",
+}
+
+#Lookup table: character byte -> mask (0 if not an IUPAC character or gap)
+ENCODE = np.zeros(256, dtype=np.uint8)
+#Lookup table: mask -> character byte (gaps win over bases, empty as N)
+DECODE = np.full(NMASKS, ord("N"), dtype=np.uint8)
+for _m, _c in IUPAC.items():
+	ENCODE[ord(_c)] = _m
+	ENCODE[ord(_c.lower())] = _m | LOWER
+	DECODE[_m] = ord(_c)
+	DECODE[_m | LOWER] = ord(_c.lower())
+	DECODE[_m | GAP] = DECODE[_m | GAP | LOWER] = ord("-")
+ENCODE[ord("-")] = GAP
+DECODE[GAP] = DECODE[GAP | LOWER] = ord("-")
+DECODE[LOWER] = ord("n")
+
+#Lookup table: mask -> number of bases it contains
+NBASES = np.array([bin(m & BASES).count("1") for m in range(NMASKS)], dtype=np.uint8)
+
+#Lookup table: mask -> its two alleles, assuming diploidy. Ambiguities of
+#more than two bases, N and gaps can't be split and give N/N (case is kept)
+SPLIT = np.empty((NMASKS, 2), dtype=np.uint8)
+for _m in range(NMASKS):
+	_bits = [b for b in (A, C, G, T) if _m & b]
+	if _m & GAP or not 1 <= len(_bits) <= 2:
+		_bits = [BASES]
+	#S has always been split as G/C (the allele order matters for ties)
+	if _m & BASES == C | G and not _m & GAP:
+		_bits = [G, C]
+	SPLIT[_m] = [_bits[0] | (_m & LOWER), _bits[-1] | (_m & LOWER)]
+del _m, _c, _bits
+
+#Encode a str, bytes or uint8 array of characters as masks
+def encode(seq):
+	if isinstance(seq, str):
+		seq = seq.encode()
+	if isinstance(seq, (bytes, bytearray)):
+		seq = np.frombuffer(seq, dtype=np.uint8)
+	return(ENCODE[seq])
+
+#Decode masks to a uint8 array of characters
+def decode(masks):
+	return(DECODE[masks])
+
+#Union of masks along an axis, e.g. the ambiguity code of a set of bases.
+#Bases and gaps are combined; the result is lowercase only if all inputs are
+def union(masks, axis=-1):
+	masks = np.asarray(masks, dtype=np.uint8)
+	ret = np.bitwise_or.reduce(masks & (BASES | GAP), axis=axis)
+	lower = np.bitwise_and.reduce(masks & LOWER, axis=axis)
+	return((ret | lower).astype(np.uint8))
+
+#Split masks into their two diploid alleles: shape (..., 2)
+def split(masks):
+	return(SPLIT[masks])
+
+#Keep only unambiguous single bases, without case (everything else as 0)
+def strict(masks):
+	masks = np.asarray(masks, dtype=np.uint8)
+	return(np.where((NBASES[masks] == 1) & (masks & GAP == 0), masks & BASES, 0).astype(np.uint8))
+
+#Count, along an axis, how many masks contain each base
+#Returns counts with a trailing axis of length 4 (A, C, G, T)
+def base_counts(masks, axis=-1):
+	masks = np.asarray(masks, dtype=np.uint8)
+	bits = np.unpackbits(masks[..., None], axis=-1, count=4, bitorder="little")
+	if axis < 0:
+		axis -= 1
+	return(bits.sum(axis=axis, dtype=np.int64))
+
+#Keep the bases of calls that can be split into two alleles (single bases
+#and heterozygous codes), without case; N, other ambiguities and gaps give 0
+def called(masks):
+	masks = np.asarray(masks, dtype=np.uint8)
+	return(np.where((NBASES[masks] <= 2) & (masks & GAP == 0), masks & BASES, 0).astype(np.uint8))
+
+#Test, along an axis, whether at least two bases are each found in at least
+#min_count of the masks: variable sites (min_count=1) or parsimony-informative
+#sites (min_count=2)
+def variable(masks, axis=-1, min_count=1):
+	counts = base_counts(masks, axis)
+	return((counts >= min_count).sum(axis=-1) >= 2)
+
+#Scalar lookups for the single-character wrappers below, built once from
+#the tables: for a character or two, plain dicts are much faster than NumPy
+_MASK = dict((chr(_i), _m) for _i, _m in enumerate(ENCODE.tolist()) if _m)
+_CHAR = [chr(_c) for _c in DECODE.tolist()]
+_PAIRS = dict()
+for _c, _m in _MASK.items():
+	_a, _b = SPLIT[_m].tolist()
+	_PAIRS[_c] = [_CHAR[_a], _CHAR[_b]]
+
+#Ambiguity code of a string of characters, as union() does for masks
+def _union_chars(chars):
+	if not chars:
+		raise KeyError(chars)
+	ret = 0
+	lower = LOWER
+	for c in chars:
+		m = _MASK[c]
+		ret |= m & (BASES | GAP)
+		lower &= m
+	return(_CHAR[ret | lower])
+
+#Ambiguity codes of every character and every sorted pair of characters
+_REVERSE = dict()
+for _c in _MASK:
+	_REVERSE[_c] = _union_chars(_c)
+	for _d in _MASK:
+		if _c < _d:
+			_REVERSE[_c + _d] = _union_chars(_c + _d)
+del _c, _d, _m, _a, _b
+
+#Function to translate a string of bases to an iupac ambiguity code, retains case
+def reverse_iupac_case(char):
+	ret = _REVERSE.get(char)
+	if ret is None:
+		ret = _union_chars(char)
+	return(ret)
+
+#Split IUPAC code to two primary characters, assuming diploidy.
+#Gives all non-valid ambiguities (and gaps) as N; case is kept
+def get_iupac_caseless(char):
+	return(list(_PAIRS[char]))
@@ -5,80 +5,287 @@ import sys
 import subprocess
 import os
 import getopt
+import glob
+import multiprocessing
+import pysam
+import numpy as np
 from collections import Counter
+import nuccodec
+from nuccodec import get_iupac_caseless
+
+# Allele codes used by the columnar model (case is kept, as in get_iupac_caseless)
+ALLELES = ["A", "C", "G", "T", "N", "a", "c", "g", "t", "n"]
+N_CODE = ALLELES.index("N")
+
+# Lookup table: character byte -> its two allele codes (-1 if not IUPAC),
+# by splitting each character's base mask into its diploid alleles
+_codes = np.full(nuccodec.NMASKS, -1, dtype=np.int8)
+_codes[nuccodec.encode("".join(ALLELES))] = np.arange(len(ALLELES))
+EXPAND = np.where(nuccodec.ENCODE[:, None] > 0, _codes[nuccodec.split(nuccodec.ENCODE)], -1).astype(np.int8)
+del _codes
+
+# Number of alignment columns encoded at a time
+COLUMN_BLOCK = 4096
 
 
 def main():
 
+	params = parseArgs()
+
+	if params.batch:
+		batch_convert(params)
+		return
+
+	names, aln = read_phylip(params.phy)
+	header = vcf_header(names)
+
+	# records are written as each block of columns is encoded
+	ofh = open_vcf_output(params.vcf, params.bgzip)
+	stats = {"columns": 0, "skipped": 0}
+	try:
+		ofh.write(header.encode())
+		for chunk in vcf_records(aln, "SPOOF", variable_only=params.variable, stats=stats):
+			ofh.write(chunk)
+	finally:
+		ofh.close()
+	if params.variable:
+		report_skipped(stats)
+
+	# index compressed output so it can be used directly by vcf2msa.py
+	if params.bgzip:
+		pysam.tabix_index(params.vcf, preset="vcf", force=True)
+
+
+# Batch mode: convert many PHYLIP files, one contig per file, into a single
+# sorted VCF. Loci are converted in parallel and written in input order
+def batch_convert(params):
+	files = find_phylip_files(params.phy, params.list)
+	if not files:
+		print("No PHYLIP files found for", params.phy or params.list)
+		sys.exit(1)
+
+	# first pass: contig names and lengths, and the union of sample names
+	contigs = dict()
+	samples = dict()
+	for f in files:
+		name = os.path.splitext(os.path.basename(f))[0]
+		if name in contigs:
+			print("Duplicate locus name %s (from %s)"%(name, f))
+			sys.exit(1)
+		names, length = read_phylip_header(f)
+		contigs[name] = (f, length)
+		for n in names:
+			samples.setdefault(n, len(samples))
+	print("Converting", len(contigs), "loci for", len(samples), "samples")
+
+	jobs = [(f, name, samples, params.variable) for name, (f, length) in contigs.items()]
+	ofh = open_vcf_output(params.vcf, params.bgzip)
+	stats = {"columns": 0, "skipped": 0}
+	try:
+		ofh.write(vcf_header(samples, [(n, l) for n, (f, l) in contigs.items()]).encode())
+		if params.procs > 1:
+			pool = multiprocessing.Pool(params.procs)
+			results = pool.imap(convert_locus, jobs, chunksize=8)
+		else:
+			pool = None
+			results = map(convert_locus, jobs)
+		for chunk, locus_stats in results:
+			ofh.write(chunk)
+			for k in stats:
+				stats[k] += locus_stats[k]
+		if pool is not None:
+			pool.close()
+			pool.join()
+	finally:
+		ofh.close()
+	if params.variable:
+		report_skipped(stats)
+
+	if params.bgzip:
+		pysam.tabix_index(params.vcf, preset="vcf", force=True)
+
+
+# Worker: convert one PHYLIP file to VCF record text for contig <name>,
+# with genotypes in the column order of samples (absent samples as ./.)
+# Returns the text and column counts
+def convert_locus(job):
+	f, name, samples, variable_only = job
+	names, aln = read_phylip(f)
+	index = np.array([samples[n] for n in names], dtype=np.int64)
+	stats = {"columns": 0, "skipped": 0}
+	text = b"".join(vcf_records(aln, name, index, len(samples), variable_only, stats))
+	return(text, stats)
+
+
+# Print how many columns were skipped as not variable
+def report_skipped(stats):
+	print("Skipped %d of %d alignment columns (monomorphic or all missing); wrote %d variable sites"%(
+		stats["skipped"], stats["columns"], stats["columns"] - stats["skipped"]))
+
+
+# Collect PHYLIP files from a directory, glob pattern, and/or list file
+def find_phylip_files(phy=None, lst=None):
+	files = list()
+	if phy:
+		if os.path.isdir(phy):
+			for f in sorted(os.listdir(phy)):
+				if os.path.splitext(f)[1].lower() in (".phy", ".phylip"):
+					files.append(os.path.join(phy, f))
+		else:
+			files.extend(sorted(glob.glob(phy)))
+	if lst:
+		with open(lst, 'r') as fh:
+			for line in fh:
+				line = line.strip()
+				if line:
+					files.append(line)
+	return(files)
+
+
+# Read sample names and alignment length of a PHYLIP file, skipping sequences
+def read_phylip_header(phy):
+	names = list()
+	length = None
+	with open(phy, 'r') as fh:
+		for line in fh:
+			line = line.strip()
+			if not line:
+				continue
+			if length is None:
+				length = int(line.split()[1])
+				continue
+			names.append(line.split(None, 1)[0])
+	return(names, length)
+
+
+# Build VCF header text for the given samples, with optional ##contig lines
+def vcf_header(samples, contigs=None):
 	header="##fileformat=VCFv4.0\n"
 	header=header + "##source=phylip2vcf.py\n"
+	if contigs:
+		for name, length in contigs:
+			header=header + "##contig=<ID=" + str(name) + ",length=" + str(length) + ">\n"
 	header=header + "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
 	header=header + "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT"
 
-	contig="SPOOF"
+	# add samples to header
+	for k in samples:
+		header = header + "\t" + str(k)
+	header = header + "\n"
+	return(header)
+
+
+# Generator yielding VCF record text (bytes) for an alignment, one block of
+# columns at a time. If index is given, row i of aln is written to sample
+# column index[i] of nsamples, and other samples are missing (./.)
+# With variable_only, only variable columns are written (POS stays the
+# alignment column), and column counts are added to stats if given
+def vcf_records(aln, contig, index=None, nsamples=None, variable_only=False, stats=None):
 	id="."
 	qual="999"
 	filter="."
 	info="."
 	format="GT"
-
-	params = parseArgs()
-
-	dat = read_phylip(params.phy)
-
-	# add samples to header
-	for k in dat.keys():
-		header = header + "\t" + str(k)
-	header = header + "\n"
-	#print(header)
-
-	records=list()
-	for i in range(0, len(dat[list(dat.keys())[0]])):
-		rec=contig + "\t" + str(i+1) + "\t" + id + "\t"
-		alleles=list()
-		for ind in dat.keys():
-			alleles.extend(get_iupac_caseless(dat[ind][i]))
-		c=Counter(alleles)
-		oc=c.most_common()
-		ref=None
-		alts=list()
-		map=dict()
-		index=0
-		map["N"]="."
-		for n in oc:
-			if n[0] != "N":
-				if not ref:
-					ref=n[0]
-					map[ref]=str(index)
-					index+=1
-				else:
-					alts.append(n[0])
-					map[n[0]]=str(index)
-					index+=1
-		# if data was all missing, set fake ref
-		if not ref:
-			ref="A"
-			map[ref]="0"
-		# if data was monomorphic, set fake alt
-		if len(alts) == 0:
-			alts="T"
-			map["T"] = "1"
-
-		rec = rec + ref + "\t" + str(",".join(alts)) + "\t" + qual + "\t" + filter + "\t" + info + "\t" + format
-		#print(rec)
-
-		for k in dat.keys():
-			gt=get_vcf_genotype(dat[k][i], map)
-			rec = rec + "\t" + gt
-		rec = rec + "\n"
-		records.append(rec)
-		#print(rec)
-		#sys.exit()
-
-	with open(params.vcf, "w") as ofh:
-		ofh.write(header)
-		for rec in records:
-			ofh.write(rec)
+	for start in range(0, aln.shape[1], COLUMN_BLOCK):
+		block = aln[:, start:start + COLUMN_BLOCK]
+		cols = np.arange(block.shape[1])
+		if variable_only:
+			cols = np.flatnonzero(variable_columns(block))
+		if stats is not None:
+			stats["columns"] += block.shape[1]
+			stats["skipped"] += block.shape[1] - len(cols)
+		if len(cols) == 0:
+			continue
+		if variable_only:
+			block = block[:, cols]
+		refs, alts, gts = encode_columns(block)
+		if index is not None:
+			full = np.empty((block.shape[1], nsamples, 4), dtype=np.uint8)
+			full[:] = np.frombuffer(b"\t./.", dtype=np.uint8)
+			full[:, index, :] = gts.reshape(block.shape[1], -1, 4)
+			gts = full.reshape(block.shape[1], nsamples * 4)
+		records=list()
+		for b in range(block.shape[1]):
+			rec = contig + "\t" + str(start+cols[b]+1) + "\t" + id + "\t" + refs[b] + "\t" + alts[b] + \
+				"\t" + qual + "\t" + filter + "\t" + info + "\t" + format
+			records.append(rec.encode() + gts[b].tobytes() + b"\n")
+		yield(b"".join(records))
+
+
+# Open VCF output for binary writing, BGZF-compressed if bgzip
+def open_vcf_output(out, bgzip=False):
+	if bgzip:
+		return(pysam.BGZFile(out, "wb"))
+	return(open(out, "wb", buffering=1 << 20))
+
+
+#Find variable columns in a block: those with at least two different
+#non-missing alleles after IUPAC expansion (i.e. with a real ALT allele)
+def variable_columns(block):
+	alleles = EXPAND[block]
+	if (alleles < 0).any():
+		bad = sorted(set(chr(c) for c in block[alleles[:, :, 0] < 0]))
+		raise ValueError("Invalid characters in alignment: %s" % ",".join(bad))
+	seen = np.zeros(block.shape[1], dtype=np.int64)
+	for c in range(len(ALLELES)):
+		if c != N_CODE:
+			seen += (alleles == c).any(axis=(0, 2))
+	return(seen >= 2)
+
+
+#Compute REF, ALT and genotype text for a block of alignment columns
+#block is a (samples x columns) uint8 matrix of IUPAC characters
+#Returns lists of REF and ALT strings, and a (columns x 4*samples) uint8
+#matrix holding the "\tA/B" genotype text of every sample, per column
+def encode_columns(block):
+	nsamp, ncol = block.shape
+	# expand IUPAC codes to two allele codes each: (samples, columns, 2)
+	alleles = EXPAND[block]
+	if (alleles < 0).any():
+		bad = sorted(set(chr(c) for c in block[alleles[:, :, 0] < 0]))
+		raise ValueError("Invalid characters in alignment: %s" % ",".join(bad))
+	# flatten alleles per column in sample order, as seen by Counter
+	flat = alleles.transpose(1, 0, 2).reshape(ncol, nsamp * 2)
+	nall = len(ALLELES)
+	counts = np.zeros((ncol, nall), dtype=np.int64)
+	first = np.full((ncol, nall), nsamp * 2, dtype=np.int64)
+	order = np.arange(nsamp * 2)
+	for c in range(nall):
+		hit = flat == c
+		counts[:, c] = hit.sum(axis=1)
+		first[:, c] = np.where(hit, order, nsamp * 2).min(axis=1)
+	# most common first, ties in order of first appearance; N is never REF/ALT
+	present = counts > 0
+	present[:, N_CODE] = False
+	key_count = np.where(present, -counts, 1)
+	ranked = np.lexsort((first, key_count), axis=1)
+	rank = np.empty_like(ranked)
+	rank[np.arange(ncol)[:, None], ranked] = np.arange(nall)
+	npresent = present.sum(axis=1)
+
+	# allele code -> GT character, per column
+	gtchar = np.where(present, ord("0") + rank, ord(".")).astype(np.uint8)
+	refs = list()
+	alts = list()
+	for b in range(ncol):
+		names = [ALLELES[c] for c in ranked[b, :npresent[b]]]
+		if not names:
+			# if data was all missing, set fake ref
+			names = ["A"]
+		if len(names) == 1:
+			# if data was monomorphic, set fake alt
+			names.append("T")
+			gtchar[b, ALLELES.index("T")] = ord("1")
+		refs.append(names[0])
+		alts.append(",".join(names[1:]))
+
+	gts = np.empty((ncol, nsamp, 4), dtype=np.uint8)
+	gts[:, :, 0] = ord("\t")
+	gts[:, :, 2] = ord("/")
+	cols = np.arange(ncol)[:, None]
+	gts[:, :, 1] = gtchar[cols, flat[:, 0::2]]
+	gts[:, :, 3] = gtchar[cols, flat[:, 1::2]]
+	return(refs, alts, gts.reshape(ncol, nsamp * 4))
 
 
 def get_vcf_genotype(gt, map):
@@ -136,6 +343,7 @@ def count_alleles(l, vcf=False):
     all_items = remove_items(all_items, ["-9", "-", "N", -9])
     return len(set(all_items))
 
+#Read a sequential PHYLIP file into (sample names, samples x columns uint8 matrix)
 def read_phylip(phy):
 	if os.path.exists(phy):
 		with open(phy, 'r') as fh:
@@ -150,101 +358,28 @@ def read_phylip(phy):
 					if num == 1:
 						continue
 					arr = line.split()
-					ret[arr[0]] = list(arr[1])
-				return(ret)
+					ret[arr[0]] = arr[1].encode()
 			except IOError:
 				print("Could not read file ",phy)
 				sys.exit(1)
 			finally:
 				fh.close()
+		if len(set(len(v) for v in ret.values())) > 1:
+			print("Sequences in %s are not all the same length"%phy)
+			sys.exit(1)
+		names = list(ret.keys())
+		aln = np.frombuffer(b"".join(ret.values()), dtype=np.uint8).reshape(len(names), -1)
+		return(names, aln)
 	else:
 		raise FileNotFoundError("File %s not found!"%phy)
 
-def get_iupac_caseless(char):
-    """Split IUPAC code to two primary characters, assuming diploidy.
-
-    Gives all non-valid ambiguities as N.
-
-    Args:
-        char (str): Base to expand into diploid list.
-
-    Returns:
-        List[str]: List of the two expanded alleles.
-    """
-    lower = False
-    if char.islower():
-        lower = True
-        char = char.upper()
-    iupac = {
-        "A": ["A", "A"],
-        "G": ["G", "G"],
-        "C": ["C", "C"],
-        "T": ["T", "T"],
-        "N": ["N", "N"],
-        "-": ["N", "N"],
-        "R": ["A", "G"],
-        "Y": ["C", "T"],
-        "S": ["G", "C"],
-        "W": ["A", "T"],
-        "K": ["G", "T"],
-        "M": ["A", "C"],
-        "B": ["N", "N"],
-        "D": ["N", "N"],
-        "H": ["N", "N"],
-        "V": ["N", "N"],
-    }
-    ret = iupac[char]
-    if lower:
-        ret = [c.lower() for c in ret]
-    return ret
-
-#Function to translate a string of bases to an iupac ambiguity code, retains case
-def reverse_iupac_case(char):
-	iupac = {
-		'A':'A',
-		'N':'N',
-		'-':'-',
-		'C':'C',
-		'G':'G',
-		'T':'T',
-		'AG':'R',
-		'CT':'Y',
-		'AC':'M',
-		'GT':'K',
-		'AT':'W',
-		'CG':'S',
-		'CGT':'B',
-		'AGT':'D',
-		'ACT':'H',
-		'ACG':'V',
-		'ACGT':'N',
-		'a':'a',
-		'n':'n',
-		'c':'c',
-		'g':'g',
-		't':'t',
-		'ag':'r',
-		'ct':'y',
-		'ac':'m',
-		'gt':'k',
-		'at':'w',
-		'cg':'s',
-		'cgt':'b',
-		'agt':'d',
-		'act':'h',
-		'acg':'v',
-		'acgt':'n'
-	}
-	return iupac[char]
-
-
 #Object to parse command-line arguments
 class parseArgs():
 	def __init__(self):
 		#Define options
 		try:
-			options, remainder = getopt.getopt(sys.argv[1:], 'hp:v:', \
-			["vcf=", "help", "phylip=", "phy="])
+			options, remainder = getopt.getopt(sys.argv[1:], 'hp:v:zl:n:V', \
+			["vcf=", "help", "phylip=", "phy=", "bgzip", "list=", "procs=", "variable"])
 		except getopt.GetoptError as err:
 			print(err)
 			self.display_help("\nExiting because getopt returned non-zero exit status.")
@@ -252,6 +387,11 @@ class parseArgs():
 		#Input params
 		self.vcf=None
 		self.phy=None
+		self.bgzip=False
+		self.list=None
+		self.procs=1
+		self.batch=False
+		self.variable=False
 
 		#First pass to see if help menu was called
 		for o, a in options:
@@ -268,6 +408,14 @@ class parseArgs():
 				self.vcf = arg
 			elif opt == "p" or opt=="phy" or opt=="phylip":
 				self.phy=arg
+			elif opt == "z" or opt == "bgzip":
+				self.bgzip=True
+			elif opt == "l" or opt == "list":
+				self.list=arg
+			elif opt == "n" or opt == "procs":
+				self.procs=int(arg)
+			elif opt == "V" or opt == "variable":
+				self.variable=True
 			elif opt == "h" or opt == "help":
 				pass
 			else:
@@ -276,8 +424,13 @@ class parseArgs():
 		#Check manditory options are set
 		if not self.vcf:
 			self.display_help("Must provide VCF output name <-v,--vcf>")
-		if not self.phy:
+		if not self.phy and not self.list:
 			self.display_help("Must provide phylip input file <-p,--phy>")
+		# batch mode for a directory, glob pattern, or list of PHYLIP files
+		if self.list or os.path.isdir(self.phy) or glob.has_magic(self.phy):
+			self.batch=True
+		if self.bgzip and not self.vcf.endswith(".gz"):
+			self.vcf = self.vcf + ".gz"
 
 	def display_help(self, message=None):
 		if message is not None:
@@ -289,10 +442,17 @@ class parseArgs():
 
 		print("""
 	Mandatory arguments:
-		-p,--phylip	: Phylip input file
+		-p,--phylip	: Phylip input file. A directory or quoted glob pattern
+		  		  converts many loci (batch mode), one contig per file
 		-v,--vcf	: VCF file containing genotypes
 
 	Other arguments:
+		-z,--bgzip	: Write bgzip-compressed VCF (adding .gz to the name if
+		  		  needed) and index it with tabix
+		-l,--list	: Text file listing PHYLIP files to convert (batch mode)
+		-n,--procs	: Number of worker processes in batch mode [default=1]
+		-V,--variable	: Only write variable sites (skip monomorphic and
+		  		  all-missing columns); POS remains the alignment column
 		-h,--help	: Displays help menu
 """)
 		print()
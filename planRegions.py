@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+import re
+import sys
+import os
+import getopt
+import numpy as np
+from findBreaksVCF import open_vcf
+
+def main():
+	params = parseArgs()
+
+	#One streaming pass to gather per-window statistics
+	print("Scanning", params.vcf, "in windows of", params.window, "bp...")
+	contigs, samples, stats = scan_windows(params.vcf, params.window, params.threads)
+	print("Found", len(contigs), "contigs and", samples, "samples")
+
+	#Flatten windows into genome order, with their expected cost
+	windows = list()
+	for chrom, length in contigs.items():
+		recs, indels = stats.get(chrom, (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)))
+		nwin = max(-(-length // params.window), len(recs))
+		for w in range(nwin):
+			start = w * params.window + 1
+			end = min((w + 1) * params.window, max(length, start))
+			r = int(recs[w]) if w < len(recs) else 0
+			i = int(indels[w]) if w < len(indels) else 0
+			windows.append([chrom, start, end, end - start + 1, r, i])
+	if not windows:
+		print("No contigs found.")
+		sys.exit(1)
+	costs = np.array([window_cost(w[3], w[4], w[5], samples, params) for w in windows])
+
+	chunks = partition(costs, params.chunks)
+
+	#Write one regfile per chunk, and the cost model alongside
+	print("Writing", len(set(chunks)), "chunks to", params.out + ".chunk*.regions")
+	write_chunks(params.out, windows, chunks)
+	write_costs(params.out + ".cost.tsv", windows, costs, chunks, samples, params)
+
+#Expected vcf2msa work for a window, in arbitrary units:
+#every base is decoded for every sample, every record is parsed for every
+#sample, and every indel triggers an alignment call
+def window_cost(bases, records, indels, samples, params):
+	return(params.base_cost * bases * samples
+		+ params.record_cost * records * samples
+		+ params.indel_cost * indels)
+
+#Stream VCF once, counting records and indels per window of each contig
+#Returns (contig lengths, number of samples, {contig: (records, indels)})
+def scan_windows(vcf_file, window, threads=1):
+	contigs = dict()
+	samples = 0
+	stats = dict()
+	chrom = None
+	recs = indels = None
+	with open_vcf(vcf_file, threads) as fh:
+		for line in fh:
+			if line.startswith("##contig"):
+				m = re.search(r"ID=([^,>]+)(?:.*length=(\d+))?", line)
+				if m:
+					contigs[m.group(1)] = int(m.group(2)) if m.group(2) else 0
+				continue
+			elif line.startswith("#CHROM"):
+				samples = max(len(line.rstrip("\n").split("\t")) - 9, 0)
+				continue
+			elif line.startswith("#"):
+				continue
+			row = line.split("\t", 5)
+			if row[0] != chrom:
+				chrom = row[0]
+				if chrom not in stats:
+					stats[chrom] = (np.zeros(64, dtype=np.int64), np.zeros(64, dtype=np.int64))
+				recs, indels = stats[chrom]
+			w = (int(row[1]) - 1) // window
+			if w >= len(recs):
+				size = max(w + 1, 2 * len(recs))
+				recs = np.concatenate((recs, np.zeros(size - len(recs), dtype=np.int64)))
+				indels = np.concatenate((indels, np.zeros(size - len(indels), dtype=np.int64)))
+				stats[chrom] = (recs, indels)
+			recs[w] += 1
+			if is_indel(row[3], row[4]):
+				indels[w] += 1
+			#contigs missing from the header, or without a length
+			if int(row[1]) > contigs.get(chrom, 0):
+				contigs[chrom] = int(row[1])
+	#trim unused windows
+	for chrom, (recs, indels) in stats.items():
+		n = -(-contigs[chrom] // window)
+		stats[chrom] = (recs[:n], indels[:n])
+	return(contigs, samples, stats)
+
+#Check if a record's alleles differ in length (i.e. needs alignment in vcf2msa)
+def is_indel(ref, alt):
+	for a in [ref] + alt.split(","):
+		if a not in (".", "*") and len(a) != 1:
+			return(True)
+	return(False)
+
+#Assign consecutive windows to n chunks of roughly equal total cost
+#Returns a chunk number (0-based) for every window
+def partition(costs, n):
+	total = np.cumsum(costs, dtype=np.float64)
+	targets = total[-1] * np.arange(1, n) / n
+	#cut after the window whose cumulative cost is closest to each target
+	cuts = np.searchsorted(total, targets)
+	for k, c in enumerate(cuts):
+		if c > 0 and abs(total[c - 1] - targets[k]) < abs(total[c] - targets[k]):
+			cuts[k] = c - 1
+	chunks = np.zeros(len(costs), dtype=np.int64)
+	for c in cuts:
+		if c + 1 < len(costs):
+			chunks[c + 1:] += 1
+	#renumber so that chunk numbers are consecutive
+	return(np.unique(chunks, return_inverse=True)[1])
+
+#Function to write each chunk as a vcf2msa regfile, merging its windows
+#into one region per contig
+def write_chunks(prefix, windows, chunks):
+	regions = list()
+	for w, k in zip(windows, chunks):
+		if regions and regions[-1][0] == k and regions[-1][1] == w[0]:
+			regions[-1][3] = w[2]
+		else:
+			regions.append([k, w[0], w[1], w[2]])
+	for k in sorted(set(chunks)):
+		f = "%s.chunk%d.regions"%(prefix, k + 1)
+		with open(f, 'w') as fh:
+			try:
+				for reg in regions:
+					if reg[0] != k:
+						continue
+					ol = "%s_%d-%d@%s:%d-%d\n"%(reg[1], reg[2], reg[3], reg[1], reg[2], reg[3])
+					fh.write(ol)
+			except IOError as e:
+				print("Could not write file %s: %s"%(f,e))
+				sys.exit(1)
+
+#Function to write per-window statistics, costs and chunk totals
+def write_costs(f, windows, costs, chunks, samples, params):
+	with open(f, 'w') as fh:
+		try:
+			fh.write("#cost = %s*bases*samples + %s*records*samples + %s*indels\n"%(
+				params.base_cost, params.record_cost, params.indel_cost))
+			fh.write("#samples=%d window=%d\n"%(samples, params.window))
+			for k in sorted(set(chunks)):
+				fh.write("#chunk%d\t%s\n"%(k + 1, repr(float(costs[chunks == k].sum()))))
+			fh.write("chunk\tchrom\tstart\tend\tbases\trecords\tindels\tcost\n")
+			for w, c, k in zip(windows, costs, chunks):
+				fh.write("%d\t%s\t%d\t%d\t%d\t%d\t%d\t%s\n"%(k + 1, w[0], w[1], w[2], w[3], w[4], w[5], repr(float(c))))
+		except IOError as e:
+			print("Could not write file %s: %s"%(f,e))
+			sys.exit(1)
+
+#Object to parse command-line arguments
+class parseArgs():
+	def __init__(self):
+		#Define options
+		try:
+			options, remainder = getopt.getopt(sys.argv[1:], 'v:n:w:o:ht:', \
+			["vcf=", "help", "chunks=", "window=", "out=", "base-cost=", "record-cost=", "indel-cost=", "threads="])
+		except getopt.GetoptError as err:
+			print(err)
+			self.display_help("\nExiting because getopt returned non-zero exit status.")
+		#Default values for params
+		#Input params
+		self.vcf=None
+		self.chunks=10
+		self.window=10000
+		self.out="out"
+		self.base_cost=1.0
+		self.record_cost=2.0
+		self.indel_cost=5000.0
+		self.threads=1
+
+		#First pass to see if help menu was called
+		for o, a in options:
+			if o in ("-h", "-help", "--help"):
+				self.display_help("Exiting because help menu was called.")
+
+		#Second pass to set all args.
+		for opt, arg_raw in options:
+			arg = arg_raw.replace(" ","")
+			arg = arg.strip()
+			opt = opt.lstrip("-")
+			#print(opt,arg)
+			if opt in ('v', 'vcf'):
+				self.vcf = arg
+			elif opt in ('n', 'chunks'):
+				self.chunks=int(arg)
+			elif opt in ('w', 'window'):
+				self.window=int(arg)
+			elif opt in ('o', 'out'):
+				self.out=arg
+			elif opt == 'base-cost':
+				self.base_cost=float(arg)
+			elif opt == 'record-cost':
+				self.record_cost=float(arg)
+			elif opt == 'indel-cost':
+				self.indel_cost=float(arg)
+			elif opt in ('t', 'threads'):
+				self.threads=int(arg)
+			elif opt in ('h', 'help'):
+				pass
+			else:
+				assert False, "Unhandled option %r"%opt
+
+		#Check manditory options are set
+		if not self.vcf:
+			self.display_help("Must provide VCF file <-v,--vcf>")
+		if self.chunks < 1 or self.window < 1:
+			self.display_help("Number of chunks and window size must be positive")
+
+	def display_help(self, message=None):
+		if message is not None:
+			print()
+			print (message)
+		print ("\nplanRegions.py\n")
+		print ("\nUsage: ", sys.argv[0], "-v <input.vcf> -n <10>\n")
+		print ("Description: Splits the genome into chunks of roughly equal expected vcf2msa compute cost")
+
+		print("""
+	Arguments:
+		-v,--vcf	: VCF file for parsing (plain or bgzipped)
+		-n,--chunks	: Number of chunks to create [default=10]
+		-w,--window	: Window size (bp) for collecting statistics [default=10000]
+		-o,--out	: Output prefix [default=out]
+		--base-cost	: Cost per base per sample [default=1]
+		--record-cost	: Cost per VCF record per sample [default=2]
+		--indel-cost	: Cost per indel (alignment call) [default=5000]
+		-t,--threads	: Decompression threads for a bgzipped VCF [default=1]
+		-h,--help	: Displays help menu
+
+""")
+		print()
+		sys.exit()
+
+#Call main function
+if __name__ == '__main__':
+    main()
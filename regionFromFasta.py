@@ -4,10 +4,41 @@ import re
 import sys
 import os
 import getopt
+import glob
+import mmap
+import multiprocessing
+import pysam
+from fastaio import read_fasta
 
 def main():
 	params = parseArgs()
 
+	if params.batch:
+		batch_slice(params)
+		return
+
+	if params.regions:
+		extract_regions(params)
+		return
+
+	s, e = get_window(params)
+	newSamps = list()
+	for seq in read_fasta(params.fasta, first_word=True):
+		keep=None
+		if e > len(seq[1]):
+			print("Warning: end coordinate",e,"exceeds sequence length.")
+			keep = seq[1][s:]
+		else:
+			keep=seq[1][s:e]
+		if keep:
+			newSamps.append((seq[0], keep))
+		else:
+			print("No sequence was kept. Something went wrong.")
+
+	write_fasta(params.out,newSamps)
+
+#Get 0-based start and end from -s/-e (end is -1 if not given)
+def get_window(params):
 	s=0
 	e=-1
 	if params.start:
@@ -26,20 +57,219 @@ def main():
 		else:
 			e=params.end-1
 	#print("end=",e)
-	newSamps = list()
-	for seq in read_fasta(params.fasta):
-		keep=None
-		if e > len(seq[1]):
-			print("Warning: end coordinate",e,"exceeds sequence length.")
-			keep = seq[1][s:]
-		else:
-			keep=seq[1][s:e]
-		if keep:
-			newSamps.append((seq[0], keep))
-		else:
-			print("No sequence was kept. Something went wrong.")
+	return(s, e)
 
-	write_fasta(params.out,newSamps)
+#Multi-file mode: apply the same regions (-R) or window (-s/-e) to many
+#FASTA files, each memory-mapped and sliced in a pool of worker processes
+def batch_slice(params):
+	if params.regions:
+		regions = list(read_regions(params.regions, params.zero))
+	else:
+		#without -e, e is -1: the last base is dropped, as in single-file mode
+		s, e = get_window(params)
+		regions = [(None, None, s, e)]
+	if not os.path.exists(params.outdir):
+		os.makedirs(params.outdir)
+
+	jobs = [(f, regions, params.outdir) for f in params.fastas]
+	print("Slicing", len(jobs), "files with", params.procs, "processes")
+	if params.procs > 1:
+		with multiprocessing.Pool(params.procs) as pool:
+			results = list(pool.imap_unordered(slice_file, jobs, chunksize=16))
+	else:
+		results = [slice_file(job) for job in jobs]
+	failed = [r for r in results if r[1]]
+	for f, msg in failed:
+		print("Warning:", f, ":", msg)
+	print("Sliced", len(results) - len(failed), "of", len(results), "files")
+
+#Worker: slice all regions from one FASTA file, writing one output per region
+#Output is <outdir>/<file> for a single -s/-e window, or
+#<outdir>/<file base>.<region name>.fasta for each region of -R
+#Returns (file, error message or None)
+def slice_file(job):
+	fas, regions, outdir = job
+	base = os.path.basename(fas)
+	try:
+		with open(fas, 'rb') as fh:
+			if os.fstat(fh.fileno()).st_size == 0:
+				return(fas, "empty file")
+			with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				records = index_records(mm)
+				names = dict((r[0].decode(), r) for r in records)
+				for name, seqs, s, e in regions:
+					if seqs is not None and seqs[0] not in names:
+						print("Warning: sequence",seqs[0],"not found, skipping region",name,"in",fas)
+						continue
+					chosen = records if seqs is None else [names[q] for q in seqs]
+					out = list()
+					for rec in chosen:
+						keep = slice_record(mm, rec, s, e)
+						if keep:
+							out.append(b">" + rec[0] + b"\n" + keep + b"\n")
+					if name is None:
+						f = os.path.join(outdir, base)
+					else:
+						f = os.path.join(outdir, os.path.splitext(base)[0] + "." + name + ".fasta")
+					with open(f, 'wb') as ofh:
+						ofh.write(b"".join(out))
+	except (IOError, OSError, ValueError) as e:
+		return(fas, str(e))
+	return(fas, None)
+
+#Locate FASTA records in a memory-mapped file without copying sequences
+#Returns a list of (name, sequence offset, length, bases per line, bytes per line)
+#Like a .fai index, this requires all lines of a record (but the last) to
+#be the same length; raises ValueError otherwise
+def index_records(mm):
+	records = list()
+	head = mm.find(b">")
+	while head >= 0:
+		eol = mm.find(b"\n", head)
+		if eol < 0:
+			break
+		name = mm[head+1:eol].split(None, 1)[0] if eol > head + 1 else b""
+		start = eol + 1
+		nxt = mm.find(b"\n>", start - 1)
+		end = len(mm) if nxt < 0 else nxt + 1
+		#line length from the first sequence line
+		first = mm.find(b"\n", start, end)
+		if first < 0:
+			first = end
+		lb = first - start
+		if lb > 0 and mm[first-1:first] == b"\r":
+			lb -= 1
+		lw = first - start + 1
+		#trim trailing newlines/whitespace from the record
+		while end > start and mm[end-1:end] in (b"\n", b"\r", b" ", b"\t"):
+			end -= 1
+		check_lines(mm, name, start, end, lb, lw)
+		nbytes = end - start
+		length = (nbytes // lw) * lb + (nbytes % lw) if lw > 0 else 0
+		records.append((name, start, length, lb, lw))
+		head = -1 if nxt < 0 else nxt + 1
+	return(records)
+
+#Check the line geometry of a record, as samtools faidx does: every line
+#but the last must take lw bytes, and the last no more than lb bases
+def check_lines(mm, name, start, end, lb, lw):
+	pos = start
+	while pos < end:
+		eol = mm.find(b"\n", pos, end)
+		if eol < 0 and end - pos <= lb:
+			return
+		if eol < 0 or eol + 1 - pos != lw:
+			raise ValueError("different line lengths in sequence %s"%name.decode())
+		pos = eol + 1
+
+#Cut [s, e) from an indexed record (e None = to the end, negative e counts
+#from the end as in seq[s:e]), copying only the slice
+def slice_record(mm, rec, s, e):
+	name, start, length, lb, lw = rec
+	if e is None or e > length:
+		e = length
+	elif e < 0:
+		e = max(length + e, 0)
+	if s >= e or lb == 0:
+		return(b"")
+	a = start + (s // lb) * lw + s % lb
+	b = start + ((e - 1) // lb) * lw + (e - 1) % lb + 1
+	chunk = mm[a:b]
+	if lw != lb:
+		chunk = chunk.replace(b"\n", b"").replace(b"\r", b"")
+	return(chunk)
+
+#Batch mode: cut every region in a regions/BED file, seeking to each slice
+#through the .fai index (built if missing) instead of re-reading the FASTA
+def extract_regions(params):
+	if not os.path.exists(params.fasta + ".fai"):
+		print("Building FASTA index for", params.fasta)
+	try:
+		fasta = pysam.FastaFile(params.fasta)
+	except (IOError, OSError, ValueError) as e:
+		print("Could not index file %s: %s"%(params.fasta,e))
+		sys.exit(1)
+	lengths = dict(zip(fasta.references, fasta.lengths))
+
+	if params.outdir and not os.path.exists(params.outdir):
+		os.makedirs(params.outdir)
+	stream = None
+	if not params.outdir:
+		stream = open(params.out, 'w')
+	try:
+		count = 0
+		for name, seqs, s, e in read_regions(params.regions, params.zero):
+			if seqs is None:
+				seqs = fasta.references
+			elif seqs[0] not in lengths:
+				print("Warning: sequence",seqs[0],"not found, skipping region",name)
+				continue
+			newSamps = list()
+			for seq in seqs:
+				end = e
+				if end > lengths[seq]:
+					print("Warning: end coordinate",end,"exceeds sequence length.")
+					end = lengths[seq]
+				keep = fasta.fetch(seq, s, end) if s < end else ""
+				if keep:
+					if stream:
+						newSamps.append(("%s:%d-%d"%(seq, s+1, end), keep))
+					else:
+						newSamps.append((seq, keep))
+				else:
+					print("No sequence was kept for",seq,"in region",name,". Something went wrong.")
+			if stream:
+				for samp in newSamps:
+					stream.write(">" + str(samp[0]) + "\n" + str(samp[1]) + "\n")
+			else:
+				write_fasta(os.path.join(params.outdir, name + ".fasta"), newSamps)
+			count += 1
+		print("Extracted",count,"regions")
+	finally:
+		if stream:
+			stream.close()
+		fasta.close()
+
+#Read regions to extract, as a generator of (name, sequences, start, end)
+#with 0-based, end-exclusive coordinates.
+#Lines may be either:
+#	start end [name]	: applied to every sequence, same coordinates as -s/-e
+#	chrom start end [name]	: BED (0-based, end-exclusive), for one sequence
+#Formats are told apart by their columns: 2 columns are "start end", 4 or
+#more are BED, and 3 are BED if the 2nd and 3rd are integers. So a 3-column
+#line of integers (e.g. "1 100 200") is read as BED, for sequence "1"
+def read_regions(r, zero=False):
+	with open(r, 'r') as fh:
+		i = 0
+		for line in fh:
+			line = line.strip()
+			if not line or line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+				continue
+			i += 1
+			stuff = line.split()
+			try:
+				if not is_bed(stuff):
+					s = int(stuff[0])
+					e = int(stuff[1])
+					if zero:
+						s = s - 1
+						e = e - 1
+					name = stuff[2] if len(stuff) > 2 else "region_%d_%d-%d"%(i, s+1, e)
+					yield(name, None, s, e)
+				else:
+					s = int(stuff[1])
+					e = int(stuff[2])
+					name = stuff[3] if len(stuff) > 3 else "%s_%d-%d"%(stuff[0], s+1, e)
+					yield(name, [stuff[0]], s, e)
+			except (IndexError, ValueError):
+				print("Bad line in regions file %s: %s"%(r,line))
+				sys.exit(1)
+
+#Check if the columns of a regions line are BED "chrom start end [name]"
+def is_bed(stuff):
+	if len(stuff) != 3:
+		return(len(stuff) > 3)
+	return(stuff[1].isdigit() and stuff[2].isdigit())
 
 #Function to write fasta-formatted sequences
 def write_fasta(f, aln):
@@ -58,49 +288,13 @@ def write_fasta(f, aln):
 		finally:
 			fh.close()
 
-#Read samples as FASTA. Generator function
-def read_fasta(fas):
-
-	if os.path.exists(fas):
-		with open(fas, 'r') as fh:
-			try:
-				contig = ""
-				seq = ""
-				for line in fh:
-					line = line.strip()
-					if not line:
-						continue
-					#print(line)
-					if line[0] == ">": #Found a header line
-						#If we already loaded a contig, yield that contig and
-						#start loading a new one
-						if contig:
-							yield([contig,seq]) #yield
-							contig = "" #reset contig and seq
-							seq = ""
-						split_line = line.split()
-						contig = (split_line[0].replace(">",""))
-					else:
-						seq += line
-				#Iyield last sequence, if it has both a header and sequence
-				if contig and seq:
-					yield([contig,seq])
-			except IOError:
-				print("Could not read file ",fas)
-				sys.exit(1)
-			finally:
-				fh.close()
-	else:
-		raise FileNotFoundError("File %s not found!"%fas)
-
-
 #Object to parse command-line arguments
 class parseArgs():
 	def __init__(self):
 		#Define options
 		try:
-			options, remainder = getopt.getopt(sys.argv[1:], 's:e:f:hzo:', \
-			["help"])
+			options, remainder = getopt.getopt(sys.argv[1:], 's:e:f:hzo:R:d:l:p:', \
+			["help", "regions=", "outdir=", "list=", "procs="])
 		except getopt.GetoptError as err:
 			print(err)
 			self.display_help("\nExiting because getopt returned non-zero exit status.")
@@ -111,6 +305,11 @@ class parseArgs():
 		self.zero=False
 		self.fasta=None
 		self.out="out.fasta"
+		self.regions=None
+		self.outdir=None
+		self.fastas=list()
+		self.batch=False
+		self.procs=1
 
 		#First pass to see if help menu was called
 		for o, a in options:
@@ -131,16 +330,36 @@ class parseArgs():
 				self.zero=True
 			elif opt == "f":
 				self.fasta = arg
+				#-f may be repeated, or given a glob pattern, for batch mode
+				if glob.has_magic(arg):
+					self.batch=True
+					self.fastas.extend(sorted(glob.glob(arg)))
+				else:
+					self.fastas.append(arg)
+			elif opt == "l" or opt == "list":
+				self.batch=True
+				with open(arg, 'r') as fh:
+					self.fastas.extend([l.strip() for l in fh if l.strip()])
+			elif opt == "p" or opt == "procs":
+				self.procs = int(arg)
 			elif opt == "o":
 				self.out = arg
+			elif opt == "R" or opt == "regions":
+				self.regions = arg
+			elif opt == "d" or opt == "outdir":
+				self.outdir = arg
 			elif opt in ('h', 'help'):
 				pass
 			else:
 				assert False, "Unhandled option %r"%opt
 
 		#Check manditory options are set
-		if not self.fasta:
+		if len(self.fastas) > 1:
+			self.batch=True
+		if not self.fastas:
 			self.display_help("Must provide FASTA file <-f>")
+		if self.batch and not self.outdir:
+			self.outdir="sliced"
 
 	def display_help(self, message=None):
 		if message is not None:
@@ -153,11 +372,21 @@ class parseArgs():
 
 		print("""
 	Arguments:
-		-f	: Fasta file
+		-f	: Fasta file. Repeat, or quote a glob, to slice many files
+		-l,--list	: Text file listing FASTA files to slice
+		-p,--procs	: Number of worker processes for many files [default=1]
 		-s	: Start coordinate (default: 1st base)
 		-e	: End coordinate (default: last base)
 		-z	: (Boolean) toggle on if coordiantes are zero-based indexing (default False)
 		-o	: Output file name (default=out.fasta)
+		-R,--regions	: File of regions to extract in one pass, one per line:
+		  		  "start end [name]" (cut from every sequence, as -s/-e),
+		  		  or BED "seq start end [name]" (one sequence, 0-based).
+		  		  Three integer columns are read as BED
+		-d,--outdir	: With -R, write each region to <outdir>/<name>.fasta
+		  		  (default: all regions to -o, with headers as seq:start-end)
+		  		  With many files, outputs go here as <file> for -s/-e, or
+		  		  <file>.<name>.fasta for -R [default=sliced]
 		-h,--help	: Displays help menu
 
 """)
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+import re
+import sys
+import os
+import glob
+import getopt
+import shutil
+import subprocess
+import multiprocessing
+
+#Scatter a vcf2msa.py regfile into balanced shards, run them (locally, or as
+#cluster jobs), and gather the shard outputs back in regfile order
+#
+#Layout of a shard directory (-d):
+#	loci.tsv		every locus of the regfile, in order, with its shard
+#	manifest.tsv		one line per shard: regfile, loci, bases, genes
+#	shard_K.regions		regfile of shard K
+#	shard_K/		working directory of shard K: vcf2msa.py outputs,
+#				vcf2msa.log and exit_status (written by "run")
+
+VCF2MSA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vcf2msa.py")
+#FASTA header written by vcf2msa.py: >contig:start-end_sample
+HEADER = re.compile(r"^>(.+):(\d+)-(\d+)_(.+)$")
+
+def main():
+	params = parseArgs()
+	if params.command == "scatter":
+		scatter(params)
+	elif params.command == "run":
+		run(params)
+	elif params.command == "gather":
+		gather(params)
+
+################################## scatter ##################################
+
+#Split the regfile into shards of balanced total length. All loci of a
+#gene go to the same shard, since vcf2msa.py appends them to one file
+def scatter(params):
+	loci = read_loci(params.regfile)
+	if not loci:
+		print("No loci found in", params.regfile)
+		sys.exit(1)
+
+	#group loci by gene, in order of first appearance
+	genes = dict()
+	for i, (gene, region, bases) in enumerate(loci):
+		genes.setdefault(gene, [i, 0, list()])
+		genes[gene][1] += bases
+		genes[gene][2].append(i)
+
+	#longest genes first, each to the shard with the fewest bases so far;
+	#ties broken by regfile order and shard number, so shards are reproducible
+	nshards = min(params.shards, len(genes))
+	load = [0] * nshards
+	shard_of = dict()
+	for gene, (first, bases, idx) in sorted(genes.items(), key=lambda g: (-g[1][1], g[1][0])):
+		k = min(range(nshards), key=lambda s: (load[s], s))
+		load[k] += bases
+		shard_of[gene] = k
+
+	os.makedirs(params.dir, exist_ok=True)
+	width = len(str(nshards))
+	names = ["shard_%0*d"%(width, k + 1) for k in range(nshards)]
+	with open(os.path.join(params.dir, "loci.tsv"), "w") as fh:
+		fh.write("index\tgene\tregion\tshard\n")
+		for i, (gene, region, bases) in enumerate(loci):
+			fh.write("%d\t%s\t%s\t%s\n"%(i + 1, gene, region, names[shard_of[gene]]))
+	with open(os.path.join(params.dir, "manifest.tsv"), "w") as fh:
+		fh.write("shard\tregfile\tloci\tbases\tgenes\n")
+		for k, name in enumerate(names):
+			members = [i for i, l in enumerate(loci) if shard_of[l[0]] == k]
+			regfile = name + ".regions"
+			with open(os.path.join(params.dir, regfile), "w") as rf:
+				for i in members:
+					rf.write("%s@%s\n"%(loci[i][0], loci[i][1]))
+			ngenes = len(set(loci[i][0] for i in members))
+			fh.write("%s\t%s\t%d\t%d\t%d\n"%(name, regfile, len(members), load[k], ngenes))
+	print("Wrote %d shards to %s (bases per shard: %d-%d)"%(nshards, params.dir, min(load), max(load)))
+
+#Read regfile lines (gene@chr:start-end) as (gene, region, length)
+def read_loci(regfile):
+	loci = list()
+	with open(regfile) as fh:
+		for line in fh:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				gene, region = line.split("@")
+				chrom, span = region.rsplit(":", 1)
+				start, end = [int(x) for x in span.split("-")]
+			except ValueError:
+				print("Bad line in regfile %s: %s"%(regfile, line))
+				sys.exit(1)
+			loci.append((gene, region, max(end - start, 0)))
+	return(loci)
+
+#Read a tab-separated table with a header line, as a list of dicts
+def read_table(f):
+	with open(f) as fh:
+		header = fh.readline().rstrip("\n").split("\t")
+		return([dict(zip(header, line.rstrip("\n").split("\t"))) for line in fh if line.strip()])
+
+#################################### run ####################################
+
+#Make vcf2msa.py arguments usable from inside a shard directory: paths are
+#made absolute, and glob patterns are expanded (vcf2msa.py doesn't expand
+#them for -m), repeating the option before each match, e.g.
+#-m "*.mpileup" -> -m /abs/a.mpileup -m /abs/b.mpileup
+def shard_args(args):
+	ret = list()
+	for i, a in enumerate(args):
+		opt = None
+		value = a
+		if a.startswith("--") and "=" in a:
+			opt, value = a.split("=", 1)
+		elif a.startswith("-"):
+			ret.append(a)
+			continue
+		matches = sorted(glob.glob(value))
+		if not matches:
+			if glob.has_magic(value):
+				print("Warning: no files match", value)
+			ret.append(a)
+			continue
+		paths = [os.path.abspath(m) for m in matches]
+		if opt is not None:
+			ret.extend(opt + "=" + p for p in paths)
+		elif i > 0 and args[i-1].startswith("-") and "=" not in args[i-1]:
+			#the option itself is already in place before the first match
+			ret.append(paths[0])
+			for p in paths[1:]:
+				ret.extend([args[i-1], p])
+		else:
+			ret.extend(paths)
+	return(ret)
+
+#Local stand-in for a cluster scheduler: run vcf2msa.py on every shard
+#(or only the failed/missing ones with --retry) in a pool of processes
+def run(params):
+	shards = read_table(os.path.join(params.dir, "manifest.tsv"))
+	if params.retry:
+		status = check_shards(params.dir)
+		shards = [s for s in shards if status[s["shard"]]]
+	args = shard_args(params.args)
+	jobs = [(os.path.abspath(params.dir), s["shard"], s["regfile"], args) for s in shards]
+	print("Running %d shards on %d processes"%(len(jobs), params.procs))
+	if params.procs > 1 and len(jobs) > 1:
+		with multiprocessing.Pool(min(params.procs, len(jobs))) as pool:
+			codes = pool.map(run_shard, jobs)
+	else:
+		codes = [run_shard(job) for job in jobs]
+	failed = [j[1] for j, c in zip(jobs, codes) if c != 0]
+	if failed:
+		print("Shards failed:", ", ".join(failed))
+		sys.exit(1)
+
+#Worker: run one shard in a clean working directory, recording its log
+#and exit status the way a cluster job script would
+def run_shard(job):
+	d, shard, regfile, args = job
+	work = os.path.join(d, shard)
+	shutil.rmtree(work, ignore_errors=True)
+	os.makedirs(work)
+	cmd = [sys.executable, VCF2MSA, "-R", os.path.join(d, regfile)] + args
+	with open(os.path.join(work, "vcf2msa.log"), "w") as log:
+		code = subprocess.call(cmd, cwd=work, stdout=log, stderr=subprocess.STDOUT)
+	with open(os.path.join(work, "exit_status"), "w") as fh:
+		fh.write("%d\n"%code)
+	return(code)
+
+################################## gather ###################################
+
+#Check every shard, then merge outputs in regfile order: one FASTA per gene
+#(locus mode) or one concatenated alignment with partitions (supermatrix)
+def gather(params):
+	status = check_shards(params.dir)
+	bad = [s for s in status if status[s]]
+	for s in bad:
+		print("Shard %s: %s"%(s, status[s]))
+	if bad and not params.partial:
+		print("%d of %d shards failed or are missing; nothing merged (use --partial to merge the rest)"%(len(bad), len(status)))
+		sys.exit(1)
+
+	#genes in order of first appearance in the regfile
+	shard_of = dict()
+	for l in read_table(os.path.join(params.dir, "loci.tsv")):
+		if l["shard"] not in bad:
+			shard_of.setdefault(l["gene"], l["shard"])
+
+	if params.mode == "locus":
+		os.makedirs(params.out, exist_ok=True)
+		for gene, shard in shard_of.items():
+			shutil.copyfile(os.path.join(params.dir, shard, gene + ".fasta"),
+				os.path.join(params.out, gene + ".fasta"))
+		print("Wrote %d locus alignments to %s"%(len(shard_of), params.out))
+	else:
+		blocks = list()
+		for gene, shard in shard_of.items():
+			for b in read_blocks(os.path.join(params.dir, shard, gene + ".fasta")):
+				blocks.append((gene, b))
+		write_supermatrix(params.out, blocks)
+	if bad:
+		sys.exit(1)
+
+#Check every shard listed in the manifest
+#Returns {shard: problem}, with an empty problem for complete shards
+def check_shards(d):
+	loci = read_table(os.path.join(d, "loci.tsv"))
+	status = dict()
+	samples = dict()
+	for s in read_table(os.path.join(d, "manifest.tsv")):
+		status[s["shard"]] = ""
+	for shard in status:
+		work = os.path.join(d, shard)
+		if not os.path.isdir(work):
+			status[shard] = "missing (never run)"
+			continue
+		code = os.path.join(work, "exit_status")
+		if os.path.exists(code):
+			with open(code) as fh:
+				c = fh.read().strip()
+			if c != "0":
+				status[shard] = "failed (exit status %s, see %s)"%(c, os.path.join(work, "vcf2msa.log"))
+				continue
+		expected = dict()
+		for l in loci:
+			if l["shard"] == shard:
+				expected.setdefault(l["gene"], list()).append(l["region"].rsplit(":", 1)[0])
+		for gene, contigs in expected.items():
+			f = os.path.join(work, gene + ".fasta")
+			if not os.path.exists(f):
+				status[shard] = "missing output %s"%f
+				break
+			try:
+				blocks = read_blocks(f)
+			except ValueError as e:
+				status[shard] = "invalid output %s: %s"%(f, e)
+				break
+			if sorted(b[0] for b in blocks) != sorted(contigs):
+				status[shard] = "incomplete output %s: %d of %d loci"%(f, len(blocks), len(contigs))
+				break
+			for contig, start, end, seqs in blocks:
+				samples[(shard, f, contig, start, end)] = tuple(samp for samp, seq in seqs)
+
+	#vcf2msa.py writes every sample for every locus
+	expected = set()
+	for found in samples.values():
+		expected.update(found)
+	for (shard, f, contig, start, end), found in samples.items():
+		if len(set(found)) < len(expected) and not status[shard]:
+			status[shard] = "incomplete output %s: %d of %d samples at %s:%s-%s"%(
+				f, len(set(found)), len(expected), contig, start, end)
+	return(status)
+
+#Read a vcf2msa.py output file as a list of loci, each (contig, start, end,
+#[(sample, sequence)]). Loci are consecutive runs of records with the same
+#coordinates; all sequences of a locus must have the same length
+def read_blocks(f):
+	blocks = list()
+	with open(f) as fh:
+		header = None
+		for line in fh:
+			line = line.rstrip("\n")
+			if line.startswith(">"):
+				m = HEADER.match(line)
+				if not m:
+					raise ValueError("bad header: %s"%line)
+				header = m.groups()
+				seen = blocks[-1][3] if blocks and blocks[-1][:3] == header[:3] else None
+				if seen is None or header[3] in [s for s, q in seen]:
+					blocks.append((header[0], header[1], header[2], list()))
+				blocks[-1][3].append((header[3], ""))
+			elif header:
+				samp, seq = blocks[-1][3][-1]
+				blocks[-1][3][-1] = (samp, seq + line)
+	for contig, s, e, seqs in blocks:
+		if len(set(len(q) for samp, q in seqs)) > 1:
+			raise ValueError("sequences of different lengths at %s:%s-%s"%(contig, s, e))
+	return(blocks)
+
+#Concatenate loci (in order) into one alignment per sample, with a
+#RAxML-style partition file giving the columns of every locus
+def write_supermatrix(prefix, blocks):
+	samples = list()
+	for gene, (contig, s, e, seqs) in blocks:
+		for samp, seq in seqs:
+			if samp not in samples:
+				samples.append(samp)
+	matrix = dict((samp, list()) for samp in samples)
+	parts = list()
+	pos = 1
+	for gene, (contig, s, e, seqs) in blocks:
+		length = len(seqs[0][1]) if seqs else 0
+		have = dict(seqs)
+		for samp in samples:
+			#samples absent from a locus are all missing data
+			matrix[samp].append(have.get(samp, "N" * length))
+		if length:
+			parts.append("DNA, %s_%s_%s-%s = %d-%d"%(gene, contig, s, e, pos, pos + length - 1))
+		pos += length
+	with open(prefix + ".fasta", "w") as fh:
+		for samp in samples:
+			fh.write(">%s\n%s\n"%(samp, "".join(matrix[samp])))
+	with open(prefix + ".partitions", "w") as fh:
+		fh.write("\n".join(parts) + "\n")
+	print("Wrote supermatrix of %d loci, %d samples and %d columns to %s.fasta (partitions in %s.partitions)"%(
+		len(blocks), len(samples), pos - 1, prefix, prefix))
+
+#Object to parse command-line arguments
+class parseArgs():
+	def __init__(self):
+		if len(sys.argv) < 2 or sys.argv[1] not in ("scatter", "run", "gather"):
+			if len(sys.argv) > 1 and sys.argv[1] in ("-h", "-help", "--help"):
+				self.display_help("Exiting because help menu was called.")
+			self.display_help("Must give a command: scatter, run or gather")
+		self.command = sys.argv[1]
+		#Define options
+		try:
+			options, remainder = getopt.getopt(sys.argv[2:], 'R:n:d:p:m:o:h', \
+			["regfile=", "shards=", "dir=", "procs=", "mode=", "out=", "retry", "partial", "help"])
+		except getopt.GetoptError as err:
+			print(err)
+			self.display_help("\nExiting because getopt returned non-zero exit status.")
+		#Default values for params
+		self.regfile=None
+		self.shards=10
+		self.dir="shards"
+		self.procs=1
+		self.mode="locus"
+		self.out=None
+		self.retry=False
+		self.partial=False
+		#arguments after "--" are passed on to vcf2msa.py
+		self.args=remainder
+
+		#First pass to see if help menu was called
+		for o, a in options:
+			if o in ("-h", "-help", "--help"):
+				self.display_help("Exiting because help menu was called.")
+
+		#Second pass to set all args.
+		for opt, arg_raw in options:
+			arg = arg_raw.replace(" ","")
+			arg = arg.strip()
+			opt = opt.lstrip("-")
+			if opt in ('R', 'regfile'):
+				self.regfile=arg
+			elif opt in ('n', 'shards'):
+				self.shards=int(arg)
+			elif opt in ('d', 'dir'):
+				self.dir=arg
+			elif opt in ('p', 'procs'):
+				self.procs=int(arg)
+			elif opt in ('m', 'mode'):
+				self.mode=arg
+			elif opt in ('o', 'out'):
+				self.out=arg
+			elif opt == 'retry':
+				self.retry=True
+			elif opt == 'partial':
+				self.partial=True
+			elif opt in ('h', 'help'):
+				pass
+			else:
+				assert False, "Unhandled option %r"%opt
+
+		#Check manditory options are set
+		if self.command == "scatter":
+			if not self.regfile:
+				self.display_help("Must provide regfile <-R,--regfile>")
+			if self.shards < 1:
+				self.display_help("Number of shards must be positive")
+		elif self.command == "run":
+			if not self.args:
+				self.display_help("Must give vcf2msa.py arguments after --")
+		elif self.command == "gather":
+			if self.mode not in ("locus", "supermatrix"):
+				self.display_help("Mode must be locus or supermatrix <-m,--mode>")
+			if not self.out:
+				self.out = "gathered" if self.mode == "locus" else "supermatrix"
+		if self.command != "scatter" and not os.path.exists(os.path.join(self.dir, "manifest.tsv")):
+			self.display_help("No shard manifest found in %s (run scatter first)"%self.dir)
+
+	def display_help(self, message=None):
+		if message is not None:
+			print()
+			print (message)
+		print ("\nscatterGather.py\n")
+		print ("\nUsage: ", sys.argv[0], "scatter -R <regions.txt> -n <10> -d <shards>")
+		print ("       ", sys.argv[0], "run -d <shards> -p <4> -- <vcf2msa.py arguments, except -R>")
+		print ("       ", sys.argv[0], "gather -d <shards> -m <locus|supermatrix> -o <out>\n")
+		print ("Description: Splits a vcf2msa.py regfile into shards, and merges the shard outputs")
+
+		print("""
+	Commands:
+		scatter		: Split the regfile into balanced shards
+		run		: Run vcf2msa.py on each shard with a local process pool
+		  		  (on a cluster, run each shard as a job instead: see README)
+		gather		: Check all shards, then merge their outputs in regfile order
+
+	Arguments:
+		-R,--regfile	: vcf2msa.py regfile to split (scatter)
+		-n,--shards	: Number of shards [default=10] (scatter)
+		-d,--dir	: Shard directory [default=shards]
+		-p,--procs	: Number of shards run at once [default=1] (run)
+		--retry		: Only run shards that failed or are missing (run)
+		-m,--mode	: Merge as one FASTA per gene (locus), or as one
+		  		  concatenated alignment with a partition file
+		  		  (supermatrix) [default=locus] (gather)
+		-o,--out	: Output directory (locus) or prefix (supermatrix)
+		  		  [default=gathered or supermatrix] (gather)
+		--partial	: Merge the complete shards even if some failed (gather)
+		-h,--help	: Displays help menu
+
+""")
+		print()
+		sys.exit()
+
+#Call main function
+if __name__ == '__main__':
+    main()
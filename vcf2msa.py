@@ -5,7 +5,16 @@ import sys
 import subprocess
 import os
 import getopt
+import glob
+import asyncio
+import collections
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import numpy as np
 import vcf
+import pysam
 import Bio
 import urllib.parse
 from os import path
@@ -14,8 +23,27 @@ from Bio import AlignIO
 from io import StringIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+from fastaio import read_fasta, open_input
+import nuccodec
+from nuccodec import reverse_iupac_case
 import subprocess
 
+# Memory model used by --max-memory, in bytes
+# decoded column: list object, plus a slot and (mostly shared) string per sample
+COLUMN_BYTES = 64
+COLUMN_SAMPLE_BYTES = 16
+# output matrix: chunk pieces, plus the joined sequence, per sample and base
+OUTPUT_BYTES = 2
+# private memory of a forked worker, beyond its share of the inputs
+WORKER_BYTES = 64 << 20
+# smallest number of positions decoded at once
+MIN_CHUNK = 16
+
+# Pipeline queue bounds: positions waiting for alignment (per clustalo
+# task), and decoded segments waiting to be written
+ALIGN_QUEUE = 4
+WRITE_QUEUE = 2
+
 
 def main():
     params = parseArgs()
@@ -35,10 +63,14 @@ def main():
             regions["locus_1"] = ChromRegion(params.region)
 
     # Grab reference sequence first
+    base_rss = peak_rss()
     reference = dict()
     print("Reading reference sequence from", params.ref)
-    for contig in read_fasta(params.ref):
+    for contig in read_fasta(params.ref, threads=params.threads):
         name = contig[0].split()[0]
+        # with a memory budget, only keep contigs that hold loci
+        if params.max_memory and not any(r.chr == name for r in regions.values()):
+            continue
         fout = "contig_" + str(name) + ".fasta"
         if params.region:   # YL
             fout = "contig_" + str(regions[params.regname].chr) + "_" + str(
@@ -50,18 +82,15 @@ def main():
             # don't forget: 0-based index here, 1-based in VCF
             reference[name] = contig[1]
 
-    # read in samples
-    vfh = vcf.Reader(filename=params.vcf)
-    samples = list()
+    # read in samples (must agree across all VCF files)
+    samples = check_samples(params.vcf)
     sampleMask = dict()  # dict of dict of sets
-    for samp in vfh.samples:
-        s = samp.split(".")[0]
-        if s not in samples:
-            samples.append(s)
-        # if s not in sampleMask:
-        # 	sampleMask[s] = dict()
 
     print("Found samples:", samples)
+    if params.keep_file or params.exclude_file:
+        found = len(samples)
+        samples = select_samples(samples, params)
+        print("Selected %d of %d samples:" % (len(samples), found), samples)
 
     # Get mask sites for each sample
     if len(reference) < 1:
@@ -73,11 +102,15 @@ def main():
             # print(maskFile)
             base = os.path.basename(maskFile)
             samp = base.split(".")[0]
+            # only load masks of the samples being aligned
+            if samp not in samples:
+                print("Skipping mask file for sample not selected:", maskFile)
+                continue
             if samp not in sampleMask:
                 sampleMask[samp] = dict()
 
             # print(samp)
-            with open(maskFile, 'r') as PILEUP:
+            with open_input(maskFile, params.threads, text=True) as PILEUP:
                 try:
                     for l in PILEUP:
                         l = l.strip()
@@ -100,7 +133,14 @@ def main():
                             if depth < params.cov:
                                 # Add to sampleMask
                                 if chrom not in sampleMask[samp]:
-                                    sampleMask[samp][chrom] = set()
+                                    if params.max_memory:
+                                        # one bit per base of loaded contigs
+                                        if chrom not in reference:
+                                            continue
+                                        sampleMask[samp][chrom] = PositionMask(
+                                            len(reference[chrom]))
+                                    else:
+                                        sampleMask[samp][chrom] = set()
                                 sampleMask[samp][chrom].add(pos)
 
                 except IOError as e:
@@ -115,178 +155,755 @@ def main():
 
         print("Found mask files:", sampleMask.keys())
 
+    # map each contig to the VCF file whose tabix index holds it
+    owners = map_contigs(params.vcf)
+    tasks = dict()
     for contig, sequence in reference.items():
-        # outFas = "contig_" + str(contig) + ".fasta"
-        # if params.region:
-        #     outFas = "contig_" + str(regions[params.regname].chr) + "_" + str(
-        #         regions[params.regname].start) + "-" + str(regions[params.regname].end) + ".fasta"
-        # with open(outFas, 'w') as fh:
-        #     fh.close()  # clear exist file
-        # loop through each region - YL
-        for locus, locus_region in regions.items():
-            #print(locus_region.gene)
-            if contig != regions[locus].chr:
-                continue
-            
-            outFas = f"{locus_region.gene}.fasta"
-            
-            outputs = dict()
-            for samp in samples:
-                outputs[samp] = str()
+        if not any(r.chr == contig for r in regions.values()):
+            continue
+        if contig not in owners:
+            print("WARNING: Contig not found in any VCF index, skipping it:", contig)
+            continue
+        tasks.setdefault(owners[contig], list()).append((contig, sequence))
+
+    # one job per VCF file: all loci of a contig go to the worker owning it
+    jobs = list()
+    for vcf_file, contigs in tasks.items():
+        masks = dict()
+        for samp in sampleMask:
+            masks[samp] = dict()
+            for contig, sequence in contigs:
+                if contig in sampleMask[samp]:
+                    masks[samp][contig] = sampleMask[samp][contig]
+        jobs.append((vcf_file, contigs, regions, samples, masks, params))
+
+    if params.max_memory:
+        plan_memory(params, jobs, reference, sampleMask, regions, samples, base_rss)
+
+    # with several jobs, each writes its loci to a staging directory per
+    # contig, so that no two workers append to the same gene file; the gene
+    # files are then put together in reference order, as one job writes them
+    if len(jobs) > 1:
+        params.stage = tempfile.mkdtemp(prefix="vcf2msa.", dir=".")
+    rows = list()
+    try:
+        if params.procs > 1 and len(jobs) > 1:
+            with multiprocessing.Pool(min(params.procs, len(jobs))) as pool:
+                for r in pool.map(process_vcf, jobs):
+                    rows.extend(r)
+        else:
+            for job in jobs:
+                rows.extend(process_vcf(job))
+        if params.stage:
+            gather_stage(params.stage, reference)
+    finally:
+        if params.stage:
+            shutil.rmtree(params.stage, ignore_errors=True)
+    contig_order = dict((contig, i) for i, contig in enumerate(reference))
+    rows.sort(key=lambda row: contig_order[row[1]])
+
+    if params.stats:
+        write_stats(params.stats, rows, samples)
+
+    if params.max_memory:
+        report_memory(params)
+
+
+# Worker: build alignments for all loci on the given contigs of one VCF file
+# Returns the --stats rows of the loci (empty without --stats)
+def process_vcf(job):
+    vcf_file, contigs, regions, samples, sampleMask, params = job
+    vfh = SampleReader(vcf_file, samples, params.threads)
+    rows = list()
+    for contig, sequence in contigs:
+        rows.extend(process_contig(vfh, contig, sequence, regions,
+                                   samples, sampleMask, params))
+    return(rows)
+
+
+# Build and write the alignment of every locus on one contig
+def process_contig(vfh, contig, sequence, regions, samples, sampleMask, params):
+    # resolve each locus on this contig to 0-based [spos, epos)
+    loci = list()
+    for locus, locus_region in regions.items():
+        if contig != locus_region.chr:
+            continue
+        spos = locus_region.start - 1
+        epos = locus_region.end - 1
+        if epos > len(sequence) or spos > (len(sequence)):
             spos = 0
             epos = len(sequence)
-            spos = regions[locus].start - 1
-            epos = regions[locus].end - 1
-            if epos > len(sequence) or spos > (len(sequence)):
-                spos = 0
-                epos = len(sequence)
-                print(
-                    "WARNING: Specified region outside of bounds: Using full contig", contig)
-            # print(spos, " ", epos)
-
-            # loop through each nuc position in contig
-            for nuc in range(spos, epos):
-                this_pos = dict()
-                for samp in samples:
-                    this_pos[samp] = str()
-                ref = None
-                # For each sequence:
-                # 1. check if any samples have VCF data (write VARIANT)
-                for rec in vfh.fetch(contig, nuc, nuc + 1):
-                    # print(rec.samples)
-                    if int(rec.POS) != int(nuc + 1):
-                        continue
-                        # sys.exit()
-                    if not ref:
-                        ref = rec.REF
-                    elif ref != rec.REF:
-                        print("Warning! Reference alleles don't match at position %s (contig %s): %s vs. %s" % (
-                            rec.POS, contig, ref, rec.REF))
-                    for ind in rec.samples:
-                        name = ind.sample.split(".")[0]
-                        if ind.gt_type:
-                            if not this_pos[name]:
-                                alleles = ind.gt_bases.replace("|", "/").split("/")
-                                this_pos[name] = genotype_resolve(alleles, params.indel)
-
-                            else:
-                                alleles = ind.gt_bases.replace("|", "/").split("/")
-                                this_pos[name] = genotype_resolve(alleles, params.indel, this_pos[name])
-
-                            # gt = "".join(sort(ind.gt_bases.split("/")))
-                            # print(ind.sample, " : ", ind.gt_bases)
-
-                # 3 insert Ns for masked samples at this position
-                if params.pileupMask:
-                    for samp in samples:
-                        if samp in sampleMask:
-                            if contig in sampleMask[samp] and nuc in sampleMask[samp][contig]:
-                                this_pos[samp] = "N"
-
-                # 4 if no allele chosen, write REF allele
-                # use REF from VCF if possible, else pull from sequence
-                for samp in samples:
-                    if not this_pos[samp] or this_pos[samp] == "":
-                        if not ref:
-                            this_pos[samp] = sequence[nuc]
-                        else:
-                            this_pos[samp] = ref
-
-                # 5. if there are insertions,  perform alignment to insert gaps
-                l = None
-                align = False
-                for key in this_pos:
-                    if not l:
-                        l = len(this_pos[key])
-                    else:
-                        if l != len(this_pos[key]):
-                            # otherwise, set for alignment
-                            align = True
-
-                # print(this_pos)
-                if align == True:
-                    old = this_pos
-                    try:
-                        # print("aligning")
-                        # print(this_pos)
-                        this_pos = clustalo_align(this_pos)
-                        # print(this_pos)
-                    except ValueError as e:
-                        print("Somethign went wrong with MUSCLE call:", e)
-                        this_pos = old
-
-                # 6 replace indels with Ns if they were masked, or pad them if removed by MUSCLE
-                maxlen = 1
-                for key in this_pos:
-                    if len(this_pos[key]) > maxlen:
-                        maxlen = len(this_pos[key])
-
-                for samp in samples:
-                    if samp in this_pos:
-                        if maxlen > 1:
-                            if samp in sampleMask:
-                                if contig in sampleMask[samp] and nuc in sampleMask[samp][contig]:
-                                    new = repeat_to_length("N", maxlen)
-                                    this_pos[samp] = new
-                                    # print("Set:",this_pos)
+            print(
+                "WARNING: Specified region outside of bounds: Using full contig", contig)
+        loci.append((locus, locus_region, spos, epos))
+
+    if params.stage:
+        os.makedirs(stage_dir(params.stage, contig), exist_ok=True)
+
+    # regfile order of the loci of each gene, in which they are written
+    order = dict()
+    for locus, locus_region, spos, epos in loci:
+        order.setdefault(locus_region.gene, collections.deque()).append(locus)
+
+    # decode each cluster of overlapping/adjacent loci once, then slice
+    # every member locus out of the shared columns
+    return(asyncio.run(pipeline_contig(vfh, contig, sequence, cluster_loci(loci),
+                                       order, samples, sampleMask, params)))
+
+
+# Run the clusters of one contig through a pipeline of asyncio tasks:
+# the decoder resolves positions and queues those with indels for the
+# clustalo tasks, then queues each decoded segment (a whole cluster, or one
+# chunk of it under a memory budget) for the writer, which waits for the
+# segment's aligned columns and appends the member loci to their FASTA.
+# Both queues are bounded, so a slow stage holds back the decoder
+# order maps each gene to its loci in regfile order, as they are written
+# Returns the --stats rows of the loci written
+async def pipeline_contig(vfh, contig, sequence, clusters, order, samples, sampleMask, params):
+    loop = asyncio.get_running_loop()
+    aligns = asyncio.Queue(ALIGN_QUEUE * params.align_jobs)
+    writes = asyncio.Queue(WRITE_QUEUE)
+    aligners = [asyncio.create_task(align_worker(aligns, contig, samples))
+                for i in range(params.align_jobs)]
+    writer = asyncio.create_task(write_worker(writes, contig, order, samples, params))
 
+    try:
+        for cstart, cend, members in clusters:
+            step = params.chunk if params.chunk else max(cend - cstart, 1)
+            a = cstart
+            while True:
+                b = min(a + step, cend)
+                columns = list()
+                for nuc in range(a, b):
+                    this_pos, align, masked = decode_alleles(
+                        vfh, contig, sequence, nuc, samples, sampleMask, params)
+                    if align:
+                        column = loop.create_future()
+                        await put_or_fail(aligns, (this_pos, nuc, masked, column), writer)
                     else:
-                        if samp in sampleMask and contig in sampleMask[samp] and nuc in sampleMask[samp][contig]:
-                            new = repeat_to_length("N", maxlen)
-                            this_pos[samp] = new
-                            # print("Set:",this_pos)
-                        else:
-                            # sample was a multiple-nucleotide deletion
-                            new = repeat_to_length("-", maxlen)
-                            this_pos[samp] = new
-                            # print("Set:",this_pos)
-
-                # 7 Make sure nothing wonky happened
-                p = False
-                pis = False
-                l = None
-                a = None
-                for samp in samples:
-                    if samp in this_pos:
-                        if not l:
-                            l = len(this_pos[samp])
-                        else:
-                            if l != len(this_pos[samp]):
-                                p = True
-                    else:
-                        p = True
-                    # if not a:
-                    # 	if this_pos[key] != "N":
-                    # 		a = this_pos[key]
-                    # else:
-                    # 	if this_pos[key] != "N" and this_pos[key] != a:
-                    # 		pis = True
-                if p == True:
-                    print("Warning: Something went wrong!")
-                    print("Position:", nuc)
-                    print(this_pos)
-                # if pis==True:
-                # 	print(this_pos)
-
-                # 8 add new bases to output string for contig/region
-                for samp in samples:
-                    outputs[samp] += this_pos[samp]
-
-            with open(outFas, 'a') as fh:
-                try:
-                    for sample in outputs:
-                        # spicific region name - YL
-                        to_write = ">" + str(contig) + ":" + str(spos + 1) + "-" + str(epos + 1) + "_" + str(sample) + "\n" + \
-                            outputs[sample] + "\n"
-                        fh.write(to_write)
-                except IOError as e:
-                    print("Could not read file:", e)
-                    sys.exit(1)
-                except Exception as e:
-                    print("Unexpected error:", e)
-                    sys.exit(1)
-                finally:
-                    fh.close()
+                        this_pos = finish_position(
+                            this_pos, contig, nuc, samples, masked)
+                        column = [this_pos[samp] for samp in samples]
+                    columns.append(column)
+                    # let the clustalo and writer tasks run
+                    await asyncio.sleep(0)
+                await put_or_fail(writes, (members, a, b, columns, b >= cend), writer)
+                if b >= cend:
+                    break
+                a = b
+
+        await put_or_fail(writes, None, writer)
+        rows = await writer
+    finally:
+        # stop the clustalo tasks between alignments (dropping any queued
+        # after a failure), rather than cancelling a starting subprocess
+        while not aligns.empty():
+            aligns.get_nowait()
+        for task in aligners:
+            await aligns.put(None)
+        await asyncio.gather(*aligners)
+    return(rows)
+
+
+# Put an item on a pipeline queue, waiting for room unless the writer
+# fails first (nothing would drain the queue then): its error is raised
+async def put_or_fail(queue, item, writer):
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        put.cancel()
+    if writer.done():
+        writer.result()
+
+
+# Align queued positions with clustalo, resolving each to its column
+async def align_worker(queue, contig, samples):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        this_pos, nuc, masked, column = item
+        try:
+            old = this_pos
+            try:
+                this_pos = await clustalo_align(this_pos)
+            except ValueError as e:
+                print("Somethign went wrong with MUSCLE call:", e)
+                this_pos = old
+            this_pos = finish_position(
+                this_pos, contig, nuc, samples, masked)
+            column.set_result([this_pos[samp] for samp in samples])
+        except Exception as e:
+            column.set_exception(e)
+
+
+# Gather decoded segments into their member loci, and append each locus
+# to its output FASTA once its cluster is complete. Clusters come in
+# coordinate order, so a locus is held back until the loci before it (in
+# regfile order) of the same gene are written. With --stats, the
+# statistics of each locus are gathered from the same pieces
+async def write_worker(queue, contig, order, samples, params):
+    loop = asyncio.get_running_loop()
+    buffers = None
+    rows = list()
+    done = dict()
+    for gene in order:
+        done[gene] = dict()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return(rows)
+        members, a, b, columns, last = item
+        for i, column in enumerate(columns):
+            if isinstance(column, asyncio.Future):
+                columns[i] = await column
+        if buffers is None:
+            buffers = [LocusBuffer(samples, params.spill) for m in members]
+            stats = [LocusStats(samples) if params.stats else None for m in members]
+        for buf, stat, (locus, locus_region, spos, epos) in zip(buffers, stats, members):
+            lo = max(spos, a)
+            hi = min(epos, b)
+            if lo < hi:
+                outputs = slice_columns(columns, samples, lo - a, hi - a)
+                buf.append(outputs)
+                if stat:
+                    stat.add(outputs)
+        if not last:
+            continue
+        for buf, stat, member in zip(buffers, stats, members):
+            gene = member[1].gene
+            done[gene][member[0]] = (buf, stat, member)
+            # write on a thread, so that decoding and alignment carry on
+            while order[gene] and order[gene][0] in done[gene]:
+                buf, stat, (locus, locus_region, spos, epos) = done[gene].pop(order[gene].popleft())
+                await loop.run_in_executor(None, buf.write, gene_file(gene, contig, params),
+                                           contig, spos, epos)
+                if stat:
+                    rows.append(stat.row(gene, contig, spos, epos))
+        buffers = None
+
+
+# Output FASTA of a gene: in the working directory, or in the staging
+# directory of the contig when several jobs are writing
+def gene_file(gene, contig, params):
+    if params.stage:
+        return(os.path.join(stage_dir(params.stage, contig), f"{gene}.fasta"))
+    return(f"{gene}.fasta")
+
+
+# Staging directory of one contig's gene files
+def stage_dir(stage, contig):
+    return(os.path.join(stage, urllib.parse.quote(contig, safe="")))
+
+
+# Append the staged gene files of each contig to the gene files in the
+# working directory, contig by contig in reference order
+def gather_stage(stage, reference):
+    for contig in reference:
+        d = stage_dir(stage, contig)
+        if not os.path.isdir(d):
+            continue
+        for f in sorted(os.listdir(d)):
+            try:
+                with open(os.path.join(d, f), 'rb') as src, open(f, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+            except IOError as e:
+                print("Could not write file %s: %s" % (f, e))
+                sys.exit(1)
+
+
+# Read sample names from each VCF, exit if they differ between files
+def check_samples(vcfs):
+    samples = None
+    for vcf_file in vcfs:
+        found = list()
+        for samp in vcf.Reader(filename=vcf_file).samples:
+            s = samp.split(".")[0]
+            if s not in found:
+                found.append(s)
+        if samples is None:
+            samples = found
+        elif found != samples:
+            print("Sample lists differ between VCF files %s and %s:" %
+                  (vcfs[0], vcf_file))
+            print(samples)
+            print(found)
+            sys.exit(1)
+    return(samples)
+
+
+# Read a file of sample names, one per line (anything after the first "."
+# is dropped, as for VCF columns)
+def read_sample_list(f):
+    names = list()
+    try:
+        with open(f, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    names.append(line.split()[0].split(".")[0])
+    except IOError as e:
+        print("Could not read file %s: %s" % (f, e))
+        sys.exit(1)
+    return(names)
+
+
+# Apply --samples and --exclude-samples to the VCF samples, keeping VCF order
+def select_samples(samples, params):
+    keep = set(samples)
+    for f, include in ((params.keep_file, True), (params.exclude_file, False)):
+        if not f:
+            continue
+        names = read_sample_list(f)
+        missing = [n for n in names if n not in samples]
+        if missing:
+            print("Samples in %s not found in the VCF:" % f, missing)
+            sys.exit(1)
+        if include:
+            keep &= set(names)
+        else:
+            keep -= set(names)
+    selected = [samp for samp in samples if samp in keep]
+    if not selected:
+        print("No samples selected.")
+        sys.exit(1)
+    return(selected)
+
+
+# PyVCF reader over a tabix-indexed VCF, restricted to the given samples
+# Its header lists only the selected sample columns, and fetched lines are
+# cut down to those columns before PyVCF splits and parses them: pysam
+# splits each line (asTuple) without making strings of the other columns.
+# htslib gets the given number of threads to decompress
+class SampleReader(vcf.Reader):
+    def __init__(self, vcf_file, samples, threads=1):
+        header = list(pysam.TabixFile(vcf_file).header)
+        fields = header[-1].split("\t")
+        keep = [i for i in range(9, len(fields)) if fields[i].split(".")[0] in samples]
+        if len(keep) < len(fields) - 9:
+            self.cols = list(range(9)) + keep
+            header[-1] = "\t".join(fields[i] for i in self.cols)
+            parser = pysam.asTuple()
+        else:
+            self.cols = None
+            parser = None
+        vcf.Reader.__init__(self, fsock=iter(header), filename=vcf_file)
+        self.tbx = pysam.TabixFile(vcf_file, parser=parser, encoding=self.encoding, threads=threads)
+
+    def fetch(self, chrom, start=None, end=None):
+        rows = self.tbx.fetch(chrom, start, end)
+        if self.cols is None:
+            self.reader = rows
+        else:
+            self.reader = ("\t".join([row[i] for i in self.cols]) for row in rows)
+        return(self)
+
+
+# Map contig names to the VCF file containing them, using tabix indices
+def map_contigs(vcfs):
+    owners = dict()
+    for vcf_file in vcfs:
+        try:
+            contigs = pysam.TabixFile(vcf_file).contigs
+        except (IOError, OSError) as e:
+            print("Could not open tabix index for %s: %s" % (vcf_file, e))
+            sys.exit(1)
+        for contig in contigs:
+            if contig in owners:
+                print("Contig %s found in more than one VCF file: %s, %s" %
+                      (contig, owners[contig], vcf_file))
+                sys.exit(1)
+            owners[contig] = vcf_file
+    return(owners)
+
+
+# Group loci into maximal clusters of overlapping or adjacent spans
+# loci is a list of (locus, region, spos, epos) tuples, 0-based half-open
+# Returns list of (start, end, members); members keep their input order
+def cluster_loci(loci):
+    order = sorted(range(len(loci)), key=lambda i: (loci[i][2], loci[i][3]))
+    clusters = list()
+    for i in order:
+        spos, epos = loci[i][2], loci[i][3]
+        if clusters and spos <= clusters[-1][1]:
+            clusters[-1][1] = max(clusters[-1][1], epos)
+            clusters[-1][2].append(i)
+        else:
+            clusters.append([spos, epos, [i]])
+    ret = list()
+    for start, end, idx in clusters:
+        ret.append((start, end, [loci[i] for i in sorted(idx)]))
+    return(ret)
+
+
+# Join the columns [a, b) of a decoded region into per-sample strings
+def slice_columns(columns, samples, a, b):
+    outputs = dict()
+    for i, samp in enumerate(samples):
+        outputs[samp] = "".join(col[i] for col in columns[a:b])
+    return(outputs)
+
+
+# Resolve the per-sample alleles for a single (0-based) position
+# Returns the alleles, whether they differ in length (need alignment), and
+# the set of samples masked as N
+def decode_alleles(vfh, contig, sequence, nuc, samples, sampleMask, params):
+    this_pos = dict()
+    for samp in samples:
+        this_pos[samp] = str()
+    ref = None
+    masked = set()
+    # For each sequence:
+    # 1. check if any samples have VCF data (write VARIANT)
+    for rec in vfh.fetch(contig, nuc, nuc + 1):
+        # print(rec.samples)
+        if int(rec.POS) != int(nuc + 1):
+            continue
+            # sys.exit()
+        if not ref:
+            ref = rec.REF
+        elif ref != rec.REF:
+            print("Warning! Reference alleles don't match at position %s (contig %s): %s vs. %s" % (
+                rec.POS, contig, ref, rec.REF))
+        # 2. mask calls failing --min-gq/--min-call-dp
+        failed = failed_calls(rec, params)
+        for i, ind in enumerate(rec.samples):
+            name = ind.sample.split(".")[0]
+            if failed is not None and failed[i]:
+                masked.add(name)
+                continue
+            if ind.gt_type:
+                if not this_pos[name]:
+                    alleles = ind.gt_bases.replace("|", "/").split("/")
+                    this_pos[name] = genotype_resolve(alleles, params.indel)
+
+                else:
+                    alleles = ind.gt_bases.replace("|", "/").split("/")
+                    this_pos[name] = genotype_resolve(alleles, params.indel, this_pos[name])
+
+                # gt = "".join(sort(ind.gt_bases.split("/")))
+                # print(ind.sample, " : ", ind.gt_bases)
+
+    # 3 insert Ns for masked samples at this position
+    if params.pileupMask:
+        for samp in samples:
+            if samp in sampleMask:
+                if contig in sampleMask[samp] and nuc in sampleMask[samp][contig]:
+                    masked.add(samp)
+    for samp in masked:
+        this_pos[samp] = "N"
+
+    # 4 if no allele chosen, write REF allele
+    # use REF from VCF if possible, else pull from sequence
+    for samp in samples:
+        if not this_pos[samp] or this_pos[samp] == "":
+            if not ref:
+                this_pos[samp] = sequence[nuc]
+            else:
+                this_pos[samp] = ref
+
+    # 5. if there are insertions,  perform alignment to insert gaps
+    l = None
+    align = False
+    for key in this_pos:
+        if not l:
+            l = len(this_pos[key])
+        else:
+            if l != len(this_pos[key]):
+                # otherwise, set for alignment
+                align = True
+
+    return(this_pos, align, masked)
+
+
+# Check the calls of a record against --min-gq and --min-call-dp, for all
+# samples at once. Returns a boolean array of failed calls (in the order of
+# rec.samples), or None if no filter applies. Missing values pass.
+def failed_calls(rec, params):
+    if params.min_gq is None and params.min_call_dp is None:
+        return(None)
+    fields = rec.FORMAT.split(":") if rec.FORMAT else list()
+    failed = None
+    for field, minimum in (("GQ", params.min_gq), ("DP", params.min_call_dp)):
+        if minimum is None or field not in fields:
+            continue
+        i = fields.index(field)
+        values = np.array([call_value(ind.data[i]) for ind in rec.samples], dtype=float)
+        fail = values < minimum
+        failed = fail if failed is None else failed | fail
+    return(failed)
+
+
+# Number held in a FORMAT value, or NaN if missing: PyVCF gives None for
+# ".", and a list of strings for a field without a ##FORMAT header line
+def call_value(v):
+    if isinstance(v, list):
+        v = v[0] if v else None
+    if v is None or v == ".":
+        return(np.nan)
+    try:
+        return(float(v))
+    except (TypeError, ValueError):
+        return(np.nan)
+
+
+# Finish a position once aligned: mask or pad indels, and check lengths
+def finish_position(this_pos, contig, nuc, samples, masked):
+    # 6 replace indels with Ns if they were masked, or pad them if removed by MUSCLE
+    maxlen = 1
+    for key in this_pos:
+        if len(this_pos[key]) > maxlen:
+            maxlen = len(this_pos[key])
+
+    for samp in samples:
+        if samp in this_pos:
+            if maxlen > 1:
+                if samp in masked:
+                    new = repeat_to_length("N", maxlen)
+                    this_pos[samp] = new
+                    # print("Set:",this_pos)
+
+        else:
+            if samp in masked:
+                new = repeat_to_length("N", maxlen)
+                this_pos[samp] = new
+                # print("Set:",this_pos)
+            else:
+                # sample was a multiple-nucleotide deletion
+                new = repeat_to_length("-", maxlen)
+                this_pos[samp] = new
+                # print("Set:",this_pos)
+
+    # 7 Make sure nothing wonky happened
+    p = False
+    l = None
+    for samp in samples:
+        if samp in this_pos:
+            if not l:
+                l = len(this_pos[samp])
+            else:
+                if l != len(this_pos[samp]):
+                    p = True
+        else:
+            p = True
+    if p == True:
+        print("Warning: Something went wrong!")
+        print("Position:", nuc)
+        print(this_pos)
+    return(this_pos)
+
+
+# Append one locus alignment to its output FASTA
+def write_locus(outFas, contig, spos, epos, outputs):
+    with open(outFas, 'a') as fh:
+        try:
+            for sample in outputs:
+                # spicific region name - YL
+                to_write = ">" + str(contig) + ":" + str(spos + 1) + "-" + str(epos + 1) + "_" + str(sample) + "\n" + \
+                    outputs[sample] + "\n"
+                fh.write(to_write)
+        except IOError as e:
+            print("Could not read file:", e)
+            sys.exit(1)
+        except Exception as e:
+            print("Unexpected error:", e)
+            sys.exit(1)
+        finally:
+            fh.close()
+
+
+# Set of masked positions on one contig, stored as one bit per base
+class PositionMask():
+    def __init__(self, length):
+        self.length = length
+        self.bits = bytearray((length + 7) // 8)
+
+    def add(self, pos):
+        if 0 <= pos < self.length:
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, pos):
+        return(0 <= pos < self.length and bool(self.bits[pos >> 3] >> (pos & 7) & 1))
+
+
+# Per-sample sequence of one locus, built chunk by chunk, either in memory
+# or spilled to a temporary file (with the offset of every piece)
+class LocusBuffer():
+    def __init__(self, samples, spill=False):
+        self.samples = samples
+        self.pieces = dict()
+        for samp in samples:
+            self.pieces[samp] = list()
+        self.fh = tempfile.TemporaryFile() if spill else None
+
+    def append(self, outputs):
+        for samp in self.samples:
+            if self.fh:
+                data = outputs[samp].encode()
+                self.pieces[samp].append((self.fh.tell(), len(data)))
+                self.fh.write(data)
+            else:
+                self.pieces[samp].append(outputs[samp])
+
+    # Append the locus to its output FASTA, as write_locus() does
+    def write(self, outFas, contig, spos, epos):
+        if not self.fh:
+            outputs = dict()
+            for samp in self.samples:
+                outputs[samp] = "".join(self.pieces[samp])
+            write_locus(outFas, contig, spos, epos, outputs)
+            return
+        with open(outFas, 'ab') as fh:
+            try:
+                for samp in self.samples:
+                    fh.write((">" + str(contig) + ":" + str(spos + 1) + "-" + str(epos + 1) + "_" + str(samp) + "\n").encode())
+                    for offset, length in self.pieces[samp]:
+                        self.fh.seek(offset)
+                        fh.write(self.fh.read(length))
+                    fh.write(b"\n")
+            except IOError as e:
+                print("Could not write file:", e)
+                sys.exit(1)
+            finally:
+                self.fh.close()
+
+
+# Alignment statistics of one locus, gathered piece by piece as it is built:
+# length, missing data (N) per sample, gaps, and variable and
+# parsimony-informative sites (as in findBreaksVCF.py; N, ambiguities of
+# three or more bases and gaps don't count as alleles)
+class LocusStats():
+    def __init__(self, samples):
+        self.samples = samples
+        self.length = 0
+        self.missing = np.zeros(len(samples), dtype=np.int64)
+        self.gaps = 0
+        self.variable = 0
+        self.informative = 0
+
+    def add(self, outputs):
+        seqs = [outputs[samp].encode() for samp in self.samples]
+        length = max((len(seq) for seq in seqs), default=0)
+        if not length:
+            return
+        # one row of masks per sample (a short row is padded with invalid masks)
+        masks = np.zeros((len(seqs), length), dtype=np.uint8)
+        for i, seq in enumerate(seqs):
+            masks[i, :len(seq)] = nuccodec.encode(seq)
+        self.length += length
+        self.missing += ((nuccodec.NBASES[masks] == 4) & (masks & nuccodec.GAP == 0)).sum(axis=1)
+        self.gaps += int((masks & nuccodec.GAP != 0).sum())
+        calls = nuccodec.called(masks)
+        self.variable += int(nuccodec.variable(calls, axis=0).sum())
+        self.informative += int(nuccodec.variable(calls, axis=0, min_count=2).sum())
+
+    # TSV fields for the locus, named as in its FASTA headers
+    def row(self, gene, contig, spos, epos):
+        fields = [gene, contig, str(spos + 1), str(epos + 1), str(self.length),
+                  str(self.variable), str(self.informative)]
+        cells = self.length * len(self.samples)
+        fields.append("%.4f" % (self.gaps / cells) if cells else "NA")
+        for missing in self.missing:
+            fields.append("%.4f" % (missing / self.length) if self.length else "NA")
+        return(fields)
+
+
+# Write the --stats table: one row per locus written
+def write_stats(f, rows, samples):
+    with open(f, 'w') as fh:
+        try:
+            header = ["locus", "contig", "start", "end", "length", "variable_sites",
+                      "informative_sites", "gap_fraction"]
+            header.extend("missing_" + samp for samp in samples)
+            fh.write("\t".join(header) + "\n")
+            for row in rows:
+                fh.write("\t".join(row) + "\n")
+        except IOError as e:
+            print("Could not write file %s: %s" % (f, e))
+            sys.exit(1)
+    print("Wrote statistics of %d loci to %s" % (len(rows), f))
+
+
+# Peak resident memory of this process, or of its largest finished child, in bytes
+def peak_rss(children=False):
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return(resource.getrusage(who).ru_maxrss * 1024)
+
+
+# Parse a memory size such as 512M or 4G (plain numbers are bytes)
+def parse_size(s):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    s = s.upper().rstrip("B")
+    if s and s[-1] in units:
+        return(int(float(s[:-1]) * units[s[-1]]))
+    return(int(s))
+
+
+def format_size(n):
+    return("%.1f MB" % (n / (1 << 20)))
+
+
+# Pick worker count, chunk size and spilling to stay under --max-memory
+# The main process holds the reference and masks; every worker gets a copy
+# of its job's contigs and masks, plus the columns of the chunk it decodes
+# and the sequences of the loci it is building
+def plan_memory(params, jobs, reference, sampleMask, regions, samples, base_rss):
+    budget = params.max_memory
+    masks = 0
+    for samp in sampleMask:
+        for contig in sampleMask[samp]:
+            masks += len(sampleMask[samp][contig].bits)
+    fixed = base_rss + sum(len(seq) for seq in reference.values()) + masks
+    job_bytes = 0
+    for vcf_file, contigs, r, s, m, p in jobs:
+        size = sum(len(seq) for contig, seq in contigs)
+        for samp in m:
+            size += sum(len(mask.bits) for mask in m[samp].values())
+        job_bytes = max(job_bytes, size)
+
+    # the output matrix of the largest set of loci on one contig
+    lengths = dict()
+    for r in regions.values():
+        if r.chr in reference:
+            n = min(r.end, len(reference[r.chr]) + 1) - r.start
+            lengths[r.chr] = lengths.get(r.chr, 0) + max(n, 0)
+    outputs = len(samples) * max(lengths.values(), default=0) * OUTPUT_BYTES
+    # chunks held at once: queued for the writer, being written and being decoded
+    column = (COLUMN_BYTES + COLUMN_SAMPLE_BYTES * len(samples)) * (WRITE_QUEUE + 2)
+
+    # drop workers until each has room for at least a minimal chunk
+    workers = max(1, min(params.procs, len(jobs)))
+    while True:
+        if workers > 1:
+            avail = (budget - fixed) // workers - WORKER_BYTES - job_bytes
+        else:
+            avail = budget - fixed
+        if avail >= MIN_CHUNK * column or workers == 1:
+            break
+        workers -= 1
+
+    params.procs = workers
+    params.spill = outputs > avail // 2
+    if not params.spill:
+        avail -= outputs
+    params.chunk = max(MIN_CHUNK, avail // column)
+
+    print("Memory budget %s: inputs %s, output matrix %s; using %d worker(s), chunks of %d positions%s" % (
+        format_size(budget), format_size(fixed), format_size(outputs), workers,
+        params.chunk, ", spilling loci to disk" if params.spill else ""))
+    if avail < MIN_CHUNK * column:
+        print("WARNING: Memory budget is too small for the inputs; running with the smallest footprint possible")
+
+
+# Report peak memory against the --max-memory budget
+def report_memory(params):
+    main_rss = peak_rss()
+    worker_rss = peak_rss(children=True)
+    print("Peak RSS: %s (main process), %s (largest child process); budget %s" % (
+        format_size(main_rss), format_size(worker_rss), format_size(params.max_memory)))
+    if max(main_rss, worker_rss) > params.max_memory:
+        print("WARNING: Peak RSS exceeded the memory budget")
+
 
 # Function to split GFF attributes
 
@@ -389,7 +1006,7 @@ def repeat_to_length(string_to_expand, length):
 
 import subprocess
 
-def clustalo_align(aln):
+async def clustalo_align(aln):
     max_len = 0
     for key, seq in aln.items():
         max_len = max(max_len, len(seq))
@@ -403,14 +1020,17 @@ def clustalo_align(aln):
     SeqIO.write(records, handle, "fasta")
     data = handle.getvalue()
 
-    # invoke clustalo with Popen
-    process = subprocess.Popen(['clustalo', '-i', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate(input=data.encode())
+    # invoke clustalo as an asyncio subprocess, so other positions are
+    # decoded and aligned while it runs
+    process = await asyncio.create_subprocess_exec(
+        'clustalo', '-i', '-', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await process.communicate(input=data.encode())
 
     # Check if there was an error running clustalo
     if process.returncode != 0:
         print("Error running Clustal Omega:")
         print(stderr.decode())
+        raise RuntimeError("clustalo exited with status %d" % process.returncode)
     else:
         # clustalo was successful, so try to read the output as an alignment
         try:
@@ -419,6 +1039,7 @@ def clustalo_align(aln):
         except Exception as e:
             print("Error reading Clustal Omega output as an alignment:")
             print(e)
+            raise
     new = dict()
     for record in alignment:
         new[record.id] = str(record.seq)
@@ -480,77 +1101,6 @@ def genotype_resolve(l, indelPriority, e=None):
                         return(i)
 
 
-# Function to translate a string of bases to an iupac ambiguity code, retains case
-def reverse_iupac_case(char):
-    iupac = {
-        'A': 'A',
-        'N': 'N',
-        '-': '-',
-        'C': 'C',
-        'G': 'G',
-        'T': 'T',
-        'AG': 'R',
-        'CT': 'Y',
-        'AC': 'M',
-        'GT': 'K',
-        'AT': 'W',
-        'CG': 'S',
-        'CGT': 'B',
-        'AGT': 'D',
-        'ACT': 'H',
-        'ACG': 'V',
-        'ACGT': 'N',
-        'a': 'a',
-        'n': 'n',
-        'c': 'c',
-        'g': 'g',
-        't': 't',
-        'ag': 'r',
-        'ct': 'y',
-        'ac': 'm',
-        'gt': 'k',
-        'at': 'w',
-        'cg': 's',
-        'cgt': 'b',
-        'agt': 'd',
-        'act': 'h',
-        'acg': 'v',
-        'acgt': 'n'
-    }
-    return iupac[char]
-
-
-# Read genome as FASTA. FASTA header will be used
-# This is a generator function
-# Doesn't matter if sequences are interleaved or not.
-def read_fasta(fas):
-    fh = open(fas)
-    try:
-        with fh as file_object:
-            contig = ""
-            seq = ""
-            for line in file_object:
-                line = line.strip()
-                if not line:
-                    continue
-                # print(line)
-                if line[0] == ">":  # Found a header line
-                    # If we already loaded a contig, yield that contig and
-                    # start loading a new one
-                    if contig:
-                        yield([contig, seq])  # yield
-                        contig = ""  # reset contig and seq
-                        seq = ""
-                    contig = (line.replace(">", ""))
-                else:
-                    seq += line
-        # Iyield last sequence, if it has both a header and sequence
-        if contig and seq:
-            yield([contig, seq])
-    finally:
-        fh.close()
-
-
 class ChromRegion():
     def __init__(self, s):
         genestuff = re.split('@', s)
@@ -567,17 +1117,19 @@ class parseArgs():
     def __init__(self):
         # Define options
         try:
-            options, remainder = getopt.getopt(sys.argv[1:], 'f:v:m:c:R:hs:f:g:dF:r:',
+            options, remainder = getopt.getopt(sys.argv[1:], 'f:v:m:c:R:hs:f:g:dF:r:p:t:',
                                                ["vcf=", "help", "ref=", "fasta=", "mpileup=", "cov=", "reg=", "indel",
                                                 "regfile=", "gff=", "dp", "force", "flank=", "id_field=",
-                                                "regname="])
+                                                "regname=", "procs=", "threads=", "max-memory=", "align-jobs=",
+                                                "min-gq=", "min-call-dp=", "samples=", "exclude-samples=",
+                                                "stats="])
         except getopt.GetoptError as err:
             print(err)
             self.display_help(
                 "\nExiting because getopt returned non-zero exit status.")
         # Default values for params
         # Input params
-        self.vcf = None
+        self.vcf = list()
         self.ref = None
         self.pileupMask = False
         self.mpileup = list()
@@ -589,6 +1141,18 @@ class parseArgs():
         self.regfile = None
         self.indel = False
         self.force = False
+        self.min_gq = None
+        self.min_call_dp = None
+        self.keep_file = None
+        self.exclude_file = None
+        self.stats = None
+        self.procs = 1
+        self.threads = 1
+        self.align_jobs = 4
+        self.max_memory = None
+        self.chunk = None
+        self.spill = False
+        self.stage = None
 
         # First pass to see if help menu was called
         for o, a in options:
@@ -602,12 +1166,35 @@ class parseArgs():
             opt = opt.replace("-", "")
             # print(opt,arg)
             if opt == "v" or opt == "vcf":
-                self.vcf = arg
+                # accept repeated -v and glob patterns (e.g. "calls.chr*.vcf.gz")
+                matches = sorted(glob.glob(arg))
+                if matches:
+                    self.vcf.extend(matches)
+                else:
+                    self.vcf.append(arg)
+            elif opt == "p" or opt == "procs":
+                self.procs = int(arg)
+            elif opt == "t" or opt == "threads":
+                self.threads = int(arg)
+            elif opt == "alignjobs":
+                self.align_jobs = max(1, int(arg))
+            elif opt == "maxmemory":
+                self.max_memory = parse_size(arg)
             elif opt == "c" or opt == "cov":
                 self.cov = int(arg)
             elif opt == "m" or opt == "mpileup":
                 self.pileupMask = True
                 self.mpileup.append(arg)
+            elif opt == "stats":
+                self.stats = arg
+            elif opt == "samples":
+                self.keep_file = arg
+            elif opt == "excludesamples":
+                self.exclude_file = arg
+            elif opt == "mingq":
+                self.min_gq = float(arg)
+            elif opt == "mincalldp":
+                self.min_call_dp = float(arg)
             elif opt == "d" or opt == "dp":
                 self.dp = True
             elif opt == "f" or opt == "fasta":
@@ -653,12 +1240,22 @@ class parseArgs():
         print("""
 	Mandatory arguments:
 		-f,--fasta	: Reference genome file (FASTA)
-		-v,--vcf	: VCF file containing genotypes
+		-v,--vcf	: VCF file containing genotypes (repeat, or quote a glob,
+		  		  for VCFs split by chromosome; each must be tabix-indexed)
 
 	Masking arguments:
 		-c,--cov	: Minimum coverage to call a base as REF [default=1]
 		-m,--mpileup: Per-sample mpileup file (one for each sample) for ALL sites (-aa in samtools)
+		  		  (may be gzip or bgzip-compressed, as may the reference)
 		-d,--dp		: Toggle on to get depth from per-sample DP scores in VCF file
+		--min-gq	: Mask calls with genotype quality (FORMAT/GQ) below this as N
+		--min-call-dp	: Mask calls with read depth (FORMAT/DP) below this as N
+		  		  (calls without the field are kept)
+
+	Sample selection arguments:
+		--samples	: File of samples to align (one per line) [default=all]
+		--exclude-samples: File of samples to leave out (one per line)
+		  		  (other samples' VCF fields are not parsed, nor their mpileups read)
 
 	Region selection arguments:
 		Must use one of:
@@ -669,6 +1266,15 @@ class parseArgs():
 		-F,--flank	: Integer representing number of bases to add on either sides of selected regions [default=0]
 		--indel		: In cases where indel conflicts with SNP call, give precedence to indel
 		--force		: Overwrite existing alignment files
+		--stats		: Write per-locus statistics (length, variable and parsimony-informative
+		  		  sites, gap fraction, per-sample missing fraction) to this TSV file
+		-p,--procs	: Number of worker processes, one per VCF file [default=1]
+		-t,--threads	: Decompression threads for bgzipped inputs, per process [default=1]
+		--align-jobs	: Concurrent clustalo alignments, per process [default=4]
+		  		  (run alongside decoding and writing)
+		--max-memory	: Memory budget (e.g. 500M, 4G). Picks the number of workers, the
+		  		  number of positions decoded at once, and whether to spill loci
+		  		  to disk, then reports the peak RSS reached
 		-h,--help	: Displays help menu
 """)
         print()